@@ -207,6 +207,11 @@ class Ui_MainWindow(object):
 
         self.gridLayout_3.addWidget(self.cb_ground, 3, 0, 1, 1)
 
+        self.cb_profile = QCheckBox(self.verticalLayoutWidget_3)
+        self.cb_profile.setObjectName(u"cb_profile")
+
+        self.gridLayout_3.addWidget(self.cb_profile, 3, 1, 1, 1)
+
         self.vlay_step_blid = QVBoxLayout()
         self.vlay_step_blid.setObjectName(u"vlay_step_blid")
         self.hlay_step = QHBoxLayout()
@@ -277,6 +282,7 @@ class Ui_MainWindow(object):
         self.cb_gapfill.setText(QCoreApplication.translate("MainWindow", u"Fill Vertical Gaps", None))
         self.lab_options.setText(QCoreApplication.translate("MainWindow", u"Options", None))
         self.cb_ground.setText(QCoreApplication.translate("MainWindow", u"Sit Map on the Ground", None))
+        self.cb_profile.setText(QCoreApplication.translate("MainWindow", u"Profile Stages", None))
         self.label_13.setText(QCoreApplication.translate("MainWindow", u"Step Clamp", None))
         self.label_15.setText(QCoreApplication.translate("MainWindow", u"BL_ID", None))
         self.but_generate.setText(QCoreApplication.translate("MainWindow", u"Generate", None))
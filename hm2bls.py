@@ -1,8 +1,94 @@
 import argparse
+import io
+import json
+import sys
 import hm2bls as hm
 from pathlib import Path
 
 
+# Argument types, kept free of numpy/Pillow so bad arguments fail fast
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer \"{value}\"")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer \"{value}\"")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be at least 0, got {number}")
+    return number
+
+
+def level_list(value: str) -> list[int]:
+    # "256,512,1024" -> [256, 512, 1024]
+    return [positive_int(level.strip()) for level in value.split(",") if level.strip()]
+
+
+def byte_size(value: str) -> int:
+    # "65536", "64K", "4M" -> bytes
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    unit = units.get(value[-1:].upper(), 1)
+    number = value[:-1] if unit > 1 else value
+    try:
+        size = int(number) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size \"{value}\"")
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1 byte, got {value}")
+    return size
+
+
+def raw_shape(value: str) -> tuple[int, int]:
+    # "4097x4097" or "4097,4097" -> (rows, columns)
+    parts = value.lower().replace(",", "x").split("x")
+    if len(parts) != 2:
+        raise argparse.ArgumentTypeError(f"invalid shape \"{value}\", use ROWSxCOLS")
+    return positive_int(parts[0].strip()), positive_int(parts[1].strip())
+
+
+def region(value: str) -> tuple[int, int, int, int]:
+    # "x0,y0,x1,y1" -> (x0, y0, x1, y1), rows x0 to x1 and columns y0 to y1 with the ends excluded
+    parts = value.split(",")
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError(f"invalid region \"{value}\", use x0,y0,x1,y1")
+    x0, y0, x1, y1 = (non_negative_int(part.strip()) for part in parts)
+    if x1 <= x0 or y1 <= y0:
+        raise argparse.ArgumentTypeError(f"empty region \"{value}\", x1 and y1 must be larger than x0 and y0")
+    return x0, y0, x1, y1
+
+
+def bl_id(value: str) -> str:
+    # BL_IDs stay strings, "-1" means no owner
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid BL_ID \"{value}\"")
+    if number < -1:
+        raise argparse.ArgumentTypeError(f"invalid BL_ID \"{value}\"")
+    return value
+
+
+def resume_settings(args) -> dict:
+    # Everything the map depends on, a journal is only resumed with the same settings
+    # Input files are compared by path, size and modification time
+    settings = {name: list(hm.SessionCache.file_key(getattr(args, name)))
+                for name in ("heightmap", "colormap", "color_bands", "colorset", "bricks", "mask") if getattr(args, name)}
+    settings.setdefault("color_bands", args.color_bands)
+    for name in ("raw_shape", "raw_dtype", "x", "y", "z", "step", "ground", "gapfill", "optimize", "quantize",
+                 "cull_alpha", "sea_level", "region", "blid"):
+        settings[name] = getattr(args, name)
+    # Same form as after a round trip through the journal
+    return json.loads(json.dumps(settings))
+
+
 def main():
     # Set up default paths
     script_dir      = Path(__file__).parent.resolve()
@@ -13,26 +99,110 @@ def main():
     
     
     parser = argparse.ArgumentParser(prog="hm2bls", description="Generate Blockland save files from 8-bit Heightmaps!")
-    parser.add_argument("-hm", "--heightmap", required=True, help="path to the heightmap")
-    parser.add_argument("-cm", "--colormap", default=path_def_cm, help="path to the color map")
+    parser.add_argument("-hm", "--heightmap", default=None, help="path to the heightmap (required unless --worker is used)")
+    parser.add_argument("--raw-shape", default=None, type=raw_shape, metavar="ROWSxCOLS", help="shape of a headerless .raw/.r16/.r32 heightmap (default: square)")
+    parser.add_argument("--raw-dtype", default=None, metavar="DTYPE", help="value type of a .raw heightmap, e.g. uint8, <u2, float32 (.r16 and .r32 imply <u2 and <f4)")
+    parser.add_argument("-cm", "--colormap", default=None, help="path to the color map")
+    parser.add_argument("--color-bands", nargs="?", const="", default=None, metavar="FILE", help="color the map by height bands and slope instead of a color map, from a JSON file (default: built-in sand, grass, rock and snow)")
     parser.add_argument("-cs", "--colorset", default=path_def_cs, help="path to the colorset")
     parser.add_argument("-o", "--output", default=path_def_out, help="output filepath")
-    parser.add_argument("-x", default=None, help="define x axis size")
-    parser.add_argument("-y", default=None, help="define y axis size")
-    parser.add_argument("-z", default=None, help="define z axis size")
-    parser.add_argument("--blid", default="-1", help="save the map with a custom BL_ID.")
+    parser.add_argument("-x", default=None, type=positive_int, help="define x axis size")
+    parser.add_argument("-y", default=None, type=positive_int, help="define y axis size")
+    parser.add_argument("-z", default=None, type=non_negative_int, help="define z axis size")
+    parser.add_argument("--region", default=None, type=region, metavar="x0,y0,x1,y1", help="only generate rows x0 to x1 and columns y0 to y1 of the map (after -x/-y), at their place in the full map")
+    parser.add_argument("--blid", default="-1", type=bl_id, help="save the map with a custom BL_ID.")
     parser.add_argument("--ground", default=False, action="store_true", help="sit the map on the ground")
     parser.add_argument("--gapfill", default=False, action="store_true", help="fill vertical gaps")
     parser.add_argument("--optimize", default=False, action="store_true", help="attempts to optimize the brickcount by using the second brick from a file")
     parser.add_argument("--bricks", default=path_def_bricks, help="select the file that defines which bricks to use")
-    parser.add_argument("--step", default="1", help="define the vertical step of the map (1 = plate, 3 = brick)")
+    parser.add_argument("--artifact", default=None, metavar="FILE", help="load the colorset and brick file from a compiled artifact, compiled first if FILE is missing or older than them")
+    parser.add_argument("--step", default=1, type=positive_int, help="define the vertical step of the map (1 = plate, 3 = brick)")
+    parser.add_argument("--quantize", default=None, type=non_negative_int, metavar="MAX_ERROR", help="snap near-equal neighbouring heights to shared levels, moving no height by more than MAX_ERROR, so --optimize can merge more bricks")
+    parser.add_argument("--cull-alpha", default=False, action="store_true", help="don't place bricks where the color map is fully transparent")
+    parser.add_argument("--mask", default=None, help="path to a mask image, no bricks are placed on its black pixels")
+    parser.add_argument("--sea-level", default=None, type=float, help="don't place bricks where the height map value is below this level (0-255 for images)")
+    parser.add_argument("--engine", choices=["reference", "numpy", "parallel", "rle"], default="numpy", help="implementation used for the map stages (default: numpy)")
+    parser.add_argument("--verify", nargs="?", const="reference", default=None, choices=["reference", "numpy", "parallel", "rle"], help="compare --engine against another engine (default: reference) stage by stage instead of writing a save")
+    parser.add_argument("--pyramid", default=None, type=level_list, help="write one save per level, e.g. 256,512,1024 (longest side in cells)")
+    parser.add_argument("--shard-size", default=None, type=positive_int, metavar="N", help="split the save into one file per NxN cell region, plus a manifest")
+    parser.add_argument("--distribute", default=None, metavar="DIR", help="render the save as tiles through a work queue in DIR, shared with --worker processes on any machine")
+    parser.add_argument("--tile-rows", default=256, type=positive_int, metavar="N", help="rows per tile for --distribute (default: 256)")
+    parser.add_argument("--workers", default=0, type=non_negative_int, metavar="N", help="local worker processes started by --distribute (default: 0, only external workers)")
+    parser.add_argument("--stale-after", default=60.0, type=float, metavar="SECONDS", help="requeue tiles whose worker hasn't reported for this long (default: 60)")
+    parser.add_argument("--worker", default=None, metavar="DIR", help="run as a worker for the work queue in DIR instead of generating a map")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="DIR", help="profile every stage and write .pstats and .collapsed (flamegraph) files to DIR (default: a \"profile\" folder next to the output)")
+    parser.add_argument("--profile-mode", choices=["cprofile", "sample"], default="cprofile", help="cprofile traces every call, sample is a low overhead stack sampler for long jobs")
+    parser.add_argument("--profile-interval", default=0.005, type=float, help="sampling interval in seconds for --profile-mode sample")
+    parser.add_argument("--write-buffer", default="1M", type=byte_size, metavar="SIZE", help="size of the blocks handed to the background writer, e.g. 64K or 4M (default: 1M)")
+    parser.add_argument("--direct-write", default=False, action="store_true", help="write unbuffered binary blocks and hint sequential access to the OS, can help on network volumes")
+    parser.add_argument("--parallel-write", default=False, action="store_true", help="render bands of rows in several processes and write each one straight to its place in the save")
+    parser.add_argument("--resume", default=False, action="store_true", help="journal the save next to the output and continue an interrupted one from its last intact chunk")
+    parser.add_argument("--jobs", default=None, type=positive_int, help="number of worker threads/processes used to run independent stages and pyramid levels (default: one per CPU)")
+    parser.add_argument("--progress", choices=["bar", "json", "none"], default=None, help="progress reporting: a progress bar, JSON lines or nothing (default: bar on a terminal)")
+    parser.add_argument("--progress-file", default=None, help="write progress to this file instead of stderr")
     
     args = parser.parse_args()
     
+    # Workers only need the queue, everything else comes from the coordinator
+    if args.worker:
+        print(f"Working on queue \"{args.worker}\"...")
+        rendered = hm.run_worker(args.worker)
+        print(f"-> Rendered {rendered} tiles")
+        return
+    
+    if args.heightmap is None:
+        parser.error("the following arguments are required: -hm/--heightmap")
+    
+    # Height bands replace the color map
+    if args.color_bands is not None and (args.colormap is not None or args.cull_alpha):
+        parser.error("--color-bands can't be combined with -cm or --cull-alpha")
+    
+    if args.color_bands is not None and (args.pyramid or args.verify):
+        parser.error("--color-bands can't be combined with --pyramid or --verify")
+    
+    if args.color_bands is None and args.colormap is None:
+        args.colormap = path_def_cm
+    
+    # "-" reads the heightmap or the colormap from stdin and writes the save to stdout
+    if args.heightmap == "-" and args.colormap == "-":
+        parser.error("only one of -hm and -cm can be read from stdin")
+    
+    if args.output == "-" and (args.pyramid or args.shard_size or args.distribute or args.parallel_write):
+        parser.error("-o - can't be combined with --pyramid, --shard-size, --distribute or --parallel-write")
+    
+    stdin_data = sys.stdin.buffer.read() if "-" in (args.heightmap, args.colormap) else None
+    
+    def source(path):
+        # Every reader gets its own copy of stdin
+        return io.BytesIO(stdin_data) if path == "-" else path
+    
+    # Only the save goes to stdout, everything else that is printed goes to stderr
+    output = sys.stdout if args.output == "-" else args.output
+    if args.output == "-":
+        sys.stdout = sys.stderr
+    
+    # Check input files before loading anything heavy
+    for name in ("heightmap", "colormap", "color_bands", "colorset", "bricks", "mask"):
+        if getattr(args, name) not in (None, "", "-") and not Path(getattr(args, name)).is_file():
+            parser.error(f"{name} \"{getattr(args, name)}\" does not exist")
+    
+    bands = None
+    if args.color_bands is not None:
+        try:
+            bands = hm.load_color_bands(args.color_bands)
+        except ValueError as e:
+            parser.error(f"color bands: {e}")
+    
+    # Set up progress reporting
+    if args.progress is None:
+        args.progress = "bar" if sys.stderr.isatty() else "none"
+    progress_stream = open(args.progress_file, "w") if args.progress_file else sys.stderr
+    progress = hm.make_progress(args.progress, progress_stream)
+    
     # Display settings used
     print(f"Generating \"{args.output}\" with settings:\n",
           f"-> Heightmap:\t{args.heightmap}\n",
-          f"-> Colormap:\t{args.colormap}\n",
+          f"-> Colormap:\t{args.colormap if bands is None else 'height bands (' + (args.color_bands or 'built-in') + ')'}\n",
           f"-> Colorset:\t{args.colorset}\n",
           f"-> Output:\t{args.output}\n",
           f"-> X size:\t{args.x}\n",
@@ -44,63 +214,258 @@ def main():
           f"-> Brick File:\t{args.bricks}\n",
           f"-> Step:\t{args.step}\n")
     
-    # Load and resize the height map
-    print(f"Loading height map \"{args.heightmap}\"...")
-    height_map = hm.load_heightmap(args.heightmap, args.x, args.y)
+    # Loading runs as a small graph of stages, the heightmap branch and the colormap branch
+    # do not depend on each other and run concurrently
+    height_steps = []
+    if args.z is not None:
+        height_steps.append(f"resizing z axis to {args.z}")
+    if args.step != 1:
+        height_steps.append(f"clamping z axis to step {args.step}")
+    if args.ground:
+        height_steps.append("grounding map")
     
-    # Load and resize colormap == heightmap
-    hm_x = height_map.shape[0]
-    hm_y = height_map.shape[1]
-    print(f"Loading color map \"{args.colormap}\"...")
-    color_map = hm.load_colormap(args.colormap, hm_x, hm_y)
+    # Colormap is matched at the heightmap's output size, which is known from the image header
+    # A smaller colormap is kept at its own size and only its color indices are resized
+    try:
+        map_size = hm.heightmap_size(source(args.heightmap), args.x, args.y, raw_shape=args.raw_shape, raw_dtype=args.raw_dtype)
+    except ValueError as e:
+        parser.error(str(e))
     
-    # Load colorset
-    print(f"Loading colorset \"{args.colorset}\"...")
-    color_set = hm.BLS_ColorSet(path=args.colorset)
-
-    # Map colorset
-    print(f"Mapping colorset...")
-    color_map = color_set.map_colors(color_map=color_map)
-
-    # Resize z axis
-    if args.z:
-        print(f"Resizing z axis to {args.z}...")
-        height_map = hm.resize_z(height_map, args.z)
-
-    # Clamp z axis to step
-    if args.step != "1":
-        print(f"Clamping z axis to step {args.step}...")
-        height_map = hm.clamp_step(height_map, args.step)
+    if args.pyramid and args.verify:
+        parser.error("--verify can't be combined with --pyramid")
     
-    # Sit map on the ground
-    if args.ground:
-        print(f"Grounding map...")
-        height_map = hm.ground(height_map)
-
-    # Load brick file
-    print(f"Loading brick file \"{args.bricks}\"...")
-    brick_file = hm.Bricks(args.bricks)
+    if args.pyramid and args.shard_size:
+        parser.error("--shard-size can't be combined with --pyramid")
+    
+    if args.distribute and (args.pyramid or args.shard_size or args.verify):
+        parser.error("--distribute can't be combined with --pyramid, --shard-size or --verify")
+    
+    if args.parallel_write and (args.pyramid or args.shard_size or args.distribute):
+        parser.error("--parallel-write can't be combined with --pyramid, --shard-size or --distribute")
+    
+    if args.region and (args.pyramid or args.shard_size or args.distribute or args.parallel_write or args.verify):
+        parser.error("--region can't be combined with --pyramid, --shard-size, --distribute, --parallel-write or --verify")
+    
+    # A region is loaded with a one cell halo so gap filling at its edges sees the cells next to it
+    window, halo = None, (0, 0, 0, 0)
+    if args.region:
+        try:
+            window, halo = hm.region_window(args.region, map_size)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"-> Region:\trows {args.region[0]}-{args.region[2]}, columns {args.region[1]}-{args.region[3]} of {map_size[0]}x{map_size[1]}")
+    
+    if args.resume and (args.pyramid or args.shard_size or args.distribute or args.parallel_write or args.verify):
+        parser.error("--resume can't be combined with --pyramid, --shard-size, --distribute, --parallel-write or --verify")
+    
+    if args.resume and "-" in (args.heightmap, args.colormap, args.output):
+        parser.error("--resume can't read from stdin or write to stdout")
+    
+    # A compiled colorset and brick file, checked against both files before it is used
+    compiled = None
+    if args.artifact:
+        try:
+            *compiled, recompiled = hm.ensure_artifact(args.artifact, args.colorset, args.bricks)
+        except ValueError as e:
+            parser.error(f"artifact: {e}")
+        print(f"{'Compiled' if recompiled else 'Loaded'} artifact \"{args.artifact}\"")
+    
+    def load_colorset():
+        return compiled[0] if compiled else hm.BLS_ColorSet(path=args.colorset)
+    
+    def load_bricks():
+        return compiled[1] if compiled else hm.Bricks(args.bricks)
+    
+    # An interrupted save continues from its map checkpoint, without loading anything else
+    if args.resume:
+        settings = resume_settings(args)
+        try:
+            checkpoint = hm.load_checkpoint(args.output, settings)
+        except ValueError as e:
+            parser.error(str(e))
+        
+        if checkpoint is not None:
+            print(f"Resuming .bls file \"{args.output}\" from its journal...")
+            summary = hm.write_resumable(checkpoint[0], bricks=load_bricks(), bl_id=args.blid,
+                                         colorset=load_colorset().get_colorset(),
+                                         output=args.output, progress=progress)
+            print(f"-> Kept {summary['resumed_at']} bytes ({summary['chunks_verified']} chunks), "
+                  f"wrote {summary['chunks_written']} chunks, {summary['bricks']} bricks in total")
+            return
+    
+    if args.pyramid and max(args.pyramid) > max(map_size):
+        parser.error(f"pyramid level {max(args.pyramid)} is larger than the heightmap ({max(map_size)} cells)")
+    
+    culling = args.cull_alpha or args.mask or args.sea_level is not None
+    
+    # Stages run one at a time while profiling so their profiles don't mix
+    if args.profile is not None:
+        profile_dir = args.profile or Path(args.output).parent / "profile"
+        profiler = hm.StageProfiler(profile_dir, mode=args.profile_mode, interval=args.profile_interval)
+    else:
+        profiler = hm.Profiler()
+    
+    pipeline = hm.Pipeline(max_workers=1 if args.profile is not None else args.jobs, profiler=profiler)
+    pipeline.add("heightmap", lambda: hm.load_heightmap(source(args.heightmap), args.x, args.y, raw_shape=args.raw_shape, raw_dtype=args.raw_dtype, window=window),
+                 message=f"Loading height map \"{args.heightmap}\"...")
+    
+    # -z, --ground and height bands scale a region by the whole map's heights
+    extrema = args.region is not None and (args.z is not None or args.ground or bands is not None)
+    if extrema:
+        pipeline.add("extrema", lambda: hm.heightmap_extrema(source(args.heightmap), args.x, args.y, raw_shape=args.raw_shape, raw_dtype=args.raw_dtype),
+                     message="Finding the height map's lowest and highest values...")
+    if bands is None:
+        pipeline.add("colormap", lambda: hm.load_colormap(source(args.colormap), *map_size, native=True),
+                     message=f"Loading color map \"{args.colormap}\"...")
+    
+    # The cull mask reads the raw heights, so it has to run before they are transformed in place
+    if culling:
+        if args.mask:
+            pipeline.add("mask", lambda: hm.load_mask(args.mask, *map_size),
+                         message=f"Loading mask \"{args.mask}\"...")
+        def build_cull(height_map, *deps):
+            inputs = dict(zip(cull_deps, deps))
+            return hm.cull_mask(color_map=inputs["colormap"] if args.cull_alpha else None, mask=inputs.get("mask"),
+                                height_map=height_map, sea_level=args.sea_level, shape=map_size, window=window)
+        
+        cull_deps = (*(("colormap",) if args.cull_alpha else ()), *(("mask",) if args.mask else ()))
+        pipeline.add("cull", build_cull, deps=("heightmap", *cull_deps),
+                     message="Building cull mask...")
+    
+    if not args.pyramid:
+        def build_heights(height_map, *deps):
+            return hm.transform_heights(height_map, z=args.z, step=args.step, ground=args.ground,
+                                        extrema=deps[-1] if extrema else None)
+        
+        pipeline.add("heights", build_heights,
+                     deps=("heightmap", *(("cull",) if culling else ()), *(("extrema",) if extrema else ())), 
+                     message=f"{', '.join(height_steps).capitalize()}..." if height_steps else None)
+        if args.quantize:
+            pipeline.add("quantized", lambda height_map: hm.quantize_heights(height_map, args.quantize, step=args.step),
+                         deps=("heights",), message=f"Quantizing heights (max error {args.quantize})...")
+    pipeline.add("colorset", load_colorset,
+                 message=None if compiled else f"Loading colorset \"{args.colorset}\"...")
+    if bands is not None:
+        def build_colors(height_map, color_set, *deps):
+            # Bands of a region span the whole map's heights
+            band_extrema = hm.transform_extrema(deps[0], z=args.z, step=args.step, ground=args.ground) if extrema else None
+            return hm.get_engine(args.engine, progress=progress, jobs=args.jobs).map_bands(color_set, height_map, bands, band_extrema)
+        
+        pipeline.add("colors", build_colors, deps=("quantized" if args.quantize else "heights", "colorset", *(("extrema",) if extrema else ())),
+                     message="Coloring height bands...")
+    elif not args.verify:
+        pipeline.add("colors", lambda color_map, color_set: hm.get_engine(args.engine, progress=progress, jobs=args.jobs).map_colors(color_set, color_map, map_size, window),
+                     deps=("colormap", "colorset"), message=f"Mapping colorset...")
+    pipeline.add("bricks", load_bricks,
+                 message=None if compiled else f"Loading brick file \"{args.bricks}\"...")
+    results = pipeline.run()
+    cull = results.get("cull")
+    
+    if cull is not None:
+        print(f"-> Culling {int(cull.sum())} of {cull.size} cells")
+    
+    # Quantized heights replace the transformed ones, which are kept to measure the effect
+    if "quantized" in results:
+        print(f"-> Quantization moved {int((results['quantized'] != results['heights']).sum())} of {results['heights'].size} cells")
+        results["original heights"] = results["heights"]
+        results["heights"] = results["quantized"]
+    
+    # Verification runs both engines on the same input and reports instead of writing a save
+    if args.verify:
+        print(f"Verifying engine \"{args.engine}\" against \"{args.verify}\"...")
+        report = hm.verify_engines(args.verify, args.engine, height_map=results["heights"], color_map=results["colormap"],
+                                   color_set=results["colorset"], bricks=results["bricks"], bl_id=args.blid,
+                                   cull_mask=cull, gapfill=args.gapfill, optimize=args.optimize, jobs=args.jobs)
+        print(report.summary())
+        sys.exit(0 if report.ok else 1)
+    
+    # Pyramid levels are derived from the full resolution arrays and built in parallel
+    if args.pyramid:
+        print(f"Generating pyramid levels {', '.join(str(level) for level in args.pyramid)}...")
+        paths = hm.generate_pyramid(levels=args.pyramid, height_map=results["heightmap"],
+                                    color_map=results["colors"], output=args.output, jobs=args.jobs,
+                                    color_set=results["colorset"], bricks=results["bricks"], bl_id=args.blid,
+                                    cull_mask=cull,
+                                    z=args.z, step=args.step, ground=args.ground, quantize=args.quantize,
+                                    gapfill=args.gapfill, optimize=args.optimize, engine=args.engine)
+        for path in paths:
+            print(f"-> Wrote \"{path}\"")
+        return
+    
+    height_map = results["heights"]
+    color_map  = results["colors"]
+    color_set  = results["colorset"]
+    brick_file = results["bricks"]
     
     # Set up map
     print(f"Setting up map...")
     map = hm.MapGenerator(bricks=brick_file, height_map=height_map, 
                           color_map=color_map, bl_id=args.blid, 
-                          color_set=color_set, output_path=args.output)
-    map.setup_map()
+                          color_set=color_set, output_path=output,
+                          cull_mask=cull, progress=progress,
+                          engine=args.engine, jobs=args.jobs,
+                          origin=(window[0], window[2]) if window else (0, 0), halo=halo)
+    with profiler.profile("setup_map"):
+        map.setup_map()
     
     # Gapfill
     if args.gapfill:
         print(f"Filling gaps...")
-        map.gap_fill()
+        with profiler.profile("gap_fill"):
+            map.gap_fill()
     
     # Brick optimization
     if args.optimize:
         print(f"Optimizing bricks...")
-        map.optimize()
+        with profiler.profile("optimize"):
+            map.optimize()
+        
+        # Merges the same map gets without quantization
+        if "quantized" in results:
+            baseline = hm.get_engine("numpy")
+            baseline.setup_map(results["original heights"], hm.exclude_halo(color_map, halo), cull)
+            baseline.optimize()
+            before, after = hm.count_merges(baseline.map_array()), hm.count_merges(map.map_array())
+            print(f"-> Quantization enabled {after - before} extra merges ({before} -> {after})")
         
-    # Create save file
-    print(f"Creating .bls file \"{args.output}\"...")
-    map.create_save()
+    # Create save file, one per shard, or one from distributed tiles
+    if args.shard_size:
+        print(f"Creating {args.shard_size}x{args.shard_size} shards of \"{args.output}\"...")
+        with profiler.profile("create_shards"):
+            manifest = map.create_shards(args.shard_size)
+        print(f"-> Wrote {len(manifest['shards'])} shards with {manifest['bricks']} bricks")
+    elif args.distribute:
+        print(f"Creating .bls file \"{args.output}\" from {args.tile_rows} row tiles queued in \"{args.distribute}\"...")
+        if not args.workers:
+            print(f"-> Waiting for workers, start them with: python hm2bls.py --worker \"{args.distribute}\"")
+        with profiler.profile("create_distributed"):
+            summary = map.create_distributed(args.distribute, tile_rows=args.tile_rows, workers=args.workers, stale_after=args.stale_after)
+        print(f"-> Merged {summary['tiles']} tiles with {summary['bricks']} bricks from {len(summary['workers'])} workers")
+        print(f"-> Scaling: {summary['busy']:.2f}s of work in {summary['wall']:.2f}s, "
+              f"{summary['speedup']:.2f}x speedup, {summary['efficiency']:.0%} efficiency")
+    elif args.resume:
+        print(f"Creating .bls file \"{args.output}\" with a journal in \"{hm.journal_dir(args.output)}\"...")
+        with profiler.profile("create_save"):
+            summary = map.create_save_resumable(settings)
+        print(f"-> Wrote {summary['chunks_written']} chunks, {summary['bricks']} bricks")
+    elif args.parallel_write:
+        print(f"Creating .bls file \"{args.output}\" with parallel writes...")
+        with profiler.profile("create_save"):
+            summary = map.create_save_parallel()
+        print(f"-> Wrote {summary['bytes']} bytes, {summary['bricks']} bricks")
+        print(f"-> Scaling: {hm.describe_scaling(summary['scaling'])}")
+    else:
+        print(f"Creating .bls file \"{args.output}\"...")
+        with profiler.profile("create_save"):
+            map.create_save(buffer_size=args.write_buffer, direct=args.direct_write)
+        if map.engine.scaling:
+            print(f"-> Scaling: {hm.describe_scaling(map.engine.scaling)}")
+    
+    if profiler.written():
+        print(f"Wrote {len(profiler.written())} profile files to \"{profiler.directory}\"")
+    
+    if args.progress_file:
+        progress_stream.close()
     
     
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+from .blsutils import BLS_ColorSet
+from .timer import timer
+
+# Compiled colorset and brick file, so a run doesn't parse either of them:
+#   magic         8 bytes, MAGIC
+#   header size   uint64, little endian
+#   header        JSON: the source files (path, size, mtime and checksum), the brick definitions,
+#                 the constant text of a brick line (Bricks.line_parts), the colorset's columns and
+#                 the offset and size of every section below
+#   sections      8 byte aligned, read through a memory map:
+#                   palette    float64 (n, 4), the colors in file order
+#                   indices    uint8 (n), the color index each palette entry maps to
+#                   colorset   the colorset as written to the save header
+# The palette is float64 rather than float32, color matching has to see the exact values the
+# colorset file gives, or a color map pixel halfway between two colors can pick the other one.
+MAGIC = b"HM2BLS\x00\x01"
+_SIZE = struct.Struct("<Q")
+_ALIGN = 8
+
+
+def _checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source(path: str | Path) -> dict:
+    path = Path(path)
+    stat = path.stat()
+    return {"path": str(path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _checksum(path)}
+
+
+def _pad(offset: int) -> int:
+    return -offset % _ALIGN
+
+
+@timer
+def compile_artifact(colorset_path: str | Path, bricks_path: str | Path, output: str | Path) -> dict:
+    # Compiles a colorset and a brick file into output, returns the artifact's header
+    from .generator import Bricks
+
+    color_set = BLS_ColorSet(path=str(colorset_path))
+    bricks = Bricks(bricks_path)
+    palette, indices = color_set.palette()
+
+    sections = [
+        ("palette", np.ascontiguousarray(palette, dtype="<f8").tobytes()),
+        ("indices", np.ascontiguousarray(indices, dtype=np.uint8).tobytes()),
+        ("colorset", color_set.get_colorset().encode()),
+    ]
+
+    # Section offsets are relative to the end of the header, which is only known once it is written
+    layout, offset = {}, 0
+    for name, data in sections:
+        layout[name] = [offset, len(data)]
+        offset += len(data) + _pad(len(data))
+
+    header = json.dumps({
+        "sources": {"colorset": _source(colorset_path), "bricks": _source(bricks_path)},
+        "colors": len(palette),
+        "columns": [len(column) for column in color_set.colorset],
+        "brick_data": bricks.brick_data,
+        "line_parts": bricks.line_parts(),
+        "sections": layout,
+    }).encode()
+    header += b" " * _pad(len(MAGIC) + _SIZE.size + len(header))
+
+    # Written next to output and renamed, a reader never sees half an artifact
+    output = Path(output)
+    tmp = output.with_name(f"{output.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as file:
+        file.write(MAGIC + _SIZE.pack(len(header)) + header)
+        for name, data in sections:
+            file.write(data + b"\0" * _pad(len(data)))
+    os.replace(tmp, output)
+
+    return json.loads(header)
+
+
+def read_header(path: str | Path) -> tuple[dict, int]:
+    # (header, offset of the first section) of an artifact
+    # Raises ValueError if path isn't an artifact of this version
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+        if magic[:6] != MAGIC[:6]:
+            raise ValueError(f"\"{path}\" is not a hm2bls artifact.")
+        if magic != MAGIC:
+            raise ValueError(f"\"{path}\" was compiled by another version of hm2bls, compile it again.")
+        try:
+            size = _SIZE.unpack(file.read(_SIZE.size))[0]
+            header = json.loads(file.read(size))
+        except (struct.error, json.JSONDecodeError) as e:
+            raise ValueError(f"\"{path}\" is damaged: {e}")
+    return header, len(MAGIC) + _SIZE.size + size
+
+
+def stale_sources(header: dict, colorset_path: str | Path, bricks_path: str | Path) -> list[str]:
+    # Names of the sources that changed since the artifact was compiled, or that are other files
+    # Size and mtime are checked first, a file that was only touched is compared by checksum
+    stale = []
+    for name, path in (("colorset", colorset_path), ("bricks", bricks_path)):
+        source = header["sources"][name]
+        path = Path(path)
+        stat = path.stat()
+        if str(path.resolve()) != source["path"] or stat.st_size != source["size"]:
+            stale.append(name)
+        elif stat.st_mtime_ns != source["mtime_ns"] and _checksum(path) != source["sha256"]:
+            stale.append(name)
+    return stale
+
+
+@timer
+def load_artifact(path: str | Path, colorset_path: str | Path, bricks_path: str | Path):
+    # (BLS_ColorSet, Bricks) from an artifact compiled from colorset_path and bricks_path
+    # Raises ValueError if the artifact is stale, compile it again with compile_artifact
+    from .generator import Bricks
+
+    header, start = read_header(path)
+    stale = stale_sources(header, colorset_path, bricks_path)
+    if stale:
+        raise ValueError(f"\"{path}\" is stale, {' and '.join(stale)} changed since it was compiled.")
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def section(name):
+        offset, size = header["sections"][name]
+        return data[start + offset:start + offset + size]
+
+    palette = section("palette").view("<f8").reshape(header["colors"], 4)
+    indices = section("indices")
+    colorset = section("colorset").tobytes().decode()
+
+    color_set = BLS_ColorSet.from_palette(palette, indices, header["columns"], colorset)
+    bricks = Bricks.from_data(header["brick_data"], header["line_parts"])
+    return color_set, bricks
+
+
+def ensure_artifact(path: str | Path, colorset_path: str | Path, bricks_path: str | Path):
+    # load_artifact, compiling the artifact first if it doesn't exist or is stale
+    # Returns (BLS_ColorSet, Bricks, compiled)
+    # Anything that isn't an artifact is left alone, it may be a file given by mistake
+    try:
+        header, _ = read_header(path)
+        compiled = bool(stale_sources(header, colorset_path, bricks_path))
+    except FileNotFoundError:
+        compiled = True
+
+    if compiled:
+        compile_artifact(colorset_path, bricks_path, path)
+    return (*load_artifact(path, colorset_path, bricks_path), compiled)
@@ -1,6 +1,11 @@
+from contextlib import nullcontext
 from dataclasses import dataclass
 from enum import Flag, auto
+import os
+import queue
+import threading
 from .timer import timer
+from .progress import Progress
 import numpy as np
 import math
 
@@ -32,6 +37,7 @@ class BLS_ColorSet:
         self.colorset = []
         self.__count = 0
         self.__colorset_str = ""
+        self.__palette = None
         
         with open(path,"r") as file:
             __column = []
@@ -69,9 +75,43 @@ class BLS_ColorSet:
                 self.colorset.append(__column)
 
         
+    @classmethod
+    def from_palette(cls, palette: np.ndarray, indices: np.ndarray, columns: list[int],
+                     colorset_str: str) -> "BLS_ColorSet":
+        # Colorset rebuilt from a compiled palette (see artifact.py) instead of parsing a colorset file
+        # palette and indices are those of palette(), columns the number of colors in each column
+        color_set = cls.__new__(cls)
+        color_set.mapped_colors = {}
+        color_set.colorset = []
+        color_set.__count = 0
+        color_set.__colorset_str = colorset_str
+        color_set.__palette = (palette, indices)
+        
+        colors = iter(palette.tolist())
+        for size in columns:
+            column = [BLS_Color(*next(colors)) for _ in range(size)]
+            for color in column:
+                color_set.mapped_colors[hash(color)] = color_set.__count
+                color_set.__count += 1
+            color_set.colorset.append(column)
+        return color_set
+    
+    def palette(self) -> tuple[np.ndarray, np.ndarray]:
+        # Colorset as a float64 (n, 4) array, plus the color index each entry maps to, built once
+        # Duplicated colors map to the last index, like mapped_colors
+        if self.__palette is None:
+            colors = [color for column in self.colorset for color in column if isinstance(color, BLS_Color)]
+            values = np.array([[color.r, color.g, color.b, color.a] for color in colors], dtype=np.float64).reshape(-1, 4)
+            indices = np.array([self.mapped_colors[hash(color)] for color in colors], dtype=np.uint8)
+            self.__palette = (values, indices)
+        return self.__palette
+    
     def get_colorset(self):
         # Colorset string for BLS file 
         # Has a trailing newline
+        # Built once, later calls return the same string
+        if self.__colorset_str:
+            return self.__colorset_str
         
         for column in self.colorset:
             for color in column:
@@ -85,8 +125,9 @@ class BLS_ColorSet:
         return self.__colorset_str
     
     @timer
-    def map_colors(self, color_map: np.ndarray) -> np.ndarray:
+    def map_colors(self, color_map: np.ndarray, progress: Progress | None = None) -> np.ndarray:
         # Maps color map to the closest color in the color set
+        progress = progress or Progress()
         
         cm = color_map.astype(np.float32)
         cm = (cm / 255)
@@ -96,6 +137,7 @@ class BLS_ColorSet:
         seen = set()
         new_color_hash_index = {}
         
+        progress.start("map_colors", len(cm))
         for i in range(0, len(cm)):
             for j in range(0,len(cm[0])):
                 color_hash = hash((cm[i][j][0],cm[i][j][1],cm[i][j][2],cm[i][j][3]))
@@ -119,6 +161,8 @@ class BLS_ColorSet:
                     seen.add(color_hash)
                     new_color_hash_index[color_hash] = hash(closest_color)              
                     csm[i][j] = self.mapped_colors[hash(closest_color)]
+            progress.advance()
+        progress.finish()
 
         return csm
 
@@ -305,23 +349,135 @@ class BLS_Brick:
         return self.brick
 
 
+class _WriterThread(threading.Thread):
+    # Writes chunks handed over through a bounded queue on its own thread
+    # put() only blocks when the queue is full, so the producer keeps formatting while the disk works
+    def __init__(self, file, queue_size: int) -> None:
+        super().__init__(daemon=True)
+        self.file = file
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+
+    def run(self) -> None:
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            try:
+                self.__write(chunk)
+            except Exception as e:
+                # Keep draining so put() never blocks on a dead writer
+                self.error = e
+
+    def __write(self, chunk) -> None:
+        # Unbuffered binary files (direct=True) can write fewer bytes than asked, network volumes
+        # especially, so bytes are written until all of them are in
+        if isinstance(chunk, str):
+            self.file.write(chunk)
+            return
+        
+        view = memoryview(chunk)
+        while view:
+            written = self.file.write(view)
+            if not written:
+                raise OSError(f"Write to \"{getattr(self.file, 'name', self.file)}\" made no progress, {len(view)} bytes left.")
+            view = view[written:]
+
+    def put(self, chunk) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put(chunk)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
 class BLS_File:
     # Interface for a BLS file
-    def __init__(self, bricks: list[BLS_Brick] | None = None, brick_count: int = 0, colorset: BLS_ColorSet = None) -> None:
+    # Bricks are joined into buffers of about buffer_size characters and written by a background thread.
+    # direct=True writes unbuffered binary blocks instead of going through a text file and hints
+    # sequential access to the OS (posix_fadvise where available), which helps on network volumes.
+    BUFFER_SIZE = 1 << 20
+    QUEUE_SIZE = 4
+    
+    # colorset can also be the already rendered colorset string (see BLS_ColorSet.get_colorset)
+    def __init__(self, bricks: list[BLS_Brick] | None = None, brick_count: int = 0, colorset: BLS_ColorSet | str = None,
+                 progress: Progress | None = None, buffer_size: int = BUFFER_SIZE, direct: bool = False) -> None:
         self.bricks = bricks
         self.brick_count = brick_count
+        self.progress = progress or Progress()
+        self.buffer_size = buffer_size
+        self.direct = direct
         self.data: str = \
             BLS_HEADER_WARNING + "\n" + \
             BLS_HEADER_DESCRIPTION + "\n" + \
-            colorset.get_colorset() + \
+            (colorset if isinstance(colorset, str) else colorset.get_colorset()) + \
             BLS_HEADER_LINECOUNT + str(self.brick_count) + "\n"
+    
+    def __open(self, path) -> tuple:
+        # (file context, whether it takes bytes)
+        # An already open text file (e.g. sys.stdout) is written as it is and left open
+        if hasattr(path, "write"):
+            return nullcontext(path), False
+        
+        if not self.direct:
+            return open(path, "w"), False
+        
+        file = open(path, "wb", buffering=0)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return file, True
+    
+    @staticmethod
+    def __encode(chunk: str, binary: bool):
+        if not binary:
+            return chunk
+        # Same line endings a text mode file would write
+        if os.linesep != "\n":
+            chunk = chunk.replace("\n", os.linesep)
+        return chunk.encode()
                 
-    def write(self, path: str) -> None:
+    def chunks(self, binary: bool = False):
+        # The header, then the bricks joined into chunks of about buffer_size characters
+        # binary chunks are bytes with the line endings a text mode file would write.
+        # Rows that are rendered on demand are only rendered when the next chunk is asked for.
         assert self.bricks != None, "self.bricks must be a non empty list!"
         
-        with open(path, "w") as file:
-            file.write(self.data)
-            print(f"Header done, ready to write {self.brick_count} bricks...")
-            for brick in self.bricks:
-                file.write(brick)
-                
\ No newline at end of file
+        yield self.__encode(self.data, binary)
+        self.progress.start("write", len(self.bricks))
+        
+        buffer = []
+        buffered = 0
+        for brick in self.bricks:
+            buffer.append(brick)
+            buffered += len(brick)
+            
+            if buffered >= self.buffer_size:
+                yield self.__encode("".join(buffer), binary)
+                buffer = []
+                buffered = 0
+            self.progress.advance()
+        
+        if buffer:
+            yield self.__encode("".join(buffer), binary)
+        self.progress.finish()
+                
+    def write(self, path) -> None:
+        # path is a file path or an open text file
+        # bricks can be any sized iterable of rows, rows that are rendered on demand are written as they come
+        context, binary = self.__open(path)
+        with context as file:
+            writer = _WriterThread(file, self.QUEUE_SIZE)
+            writer.start()
+            
+            try:
+                for index, chunk in enumerate(self.chunks(binary)):
+                    writer.put(chunk)
+                    if index == 0:
+                        print(f"Header done, ready to write {self.brick_count} bricks...")
+            finally:
+                writer.close()
+            file.flush()
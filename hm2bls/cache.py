@@ -0,0 +1,40 @@
+from pathlib import Path
+
+
+class SessionCache:
+    # Keeps the result of every stage between runs of one session
+    # Each stage remembers its latest result and the key it was made with. The key holds
+    # everything the result depends on: input files (see file_key) and parameters, plus the keys
+    # of the stages it was made from, so changing an input only invalidates the stages after it.
+    # Cached arrays are made read only, so a stage can't change a result another run reuses.
+    def __init__(self) -> None:
+        self.__entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(path: str | Path) -> tuple:
+        # A file changes when its mtime or size does
+        path = Path(path)
+        stat = path.stat()
+        return str(path.resolve()), stat.st_mtime_ns, stat.st_size
+
+    def get(self, stage: str, key, compute):
+        # Result of compute() for key, computed only when the stage has no result for key yet
+        entry = self.__entries.get(stage)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+
+        value = compute()
+        if hasattr(value, "setflags"):
+            value.setflags(write=False)
+        self.__entries[stage] = (key, value)
+        self.misses += 1
+        return value
+
+    def clear(self, stage: str | None = None) -> None:
+        if stage is None:
+            self.__entries.clear()
+        else:
+            self.__entries.pop(stage, None)
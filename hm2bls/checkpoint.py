@@ -0,0 +1,223 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .blsutils import BLS_File
+from .engines import BrickFormatter, render_rows, UBID_INDEX, VBC_INDEX
+from .offsets import _encode
+from .progress import Progress
+
+# Journal of a resumable save, a directory next to the output (out/map.bls -> out/map.bls.journal):
+#   map.npy         the finished map, so a resumed run skips loading and every map stage
+#   journal.jsonl   one JSON object per line, appended and synced in order:
+#                   {"map": ...}      settings the map was made with and the checksum of map.npy
+#                   {"header": ...}   size and checksum of the header
+#                   {"chunk": ...}    rows, offset, size, checksum and running brick count of every
+#                                     chunk of rows written after the header
+# A line is only appended once the data it describes is on disk, so the journal never claims more
+# than the output holds. A torn last line (crash while appending) is ignored.
+JOURNAL_FILE = "journal.jsonl"
+MAP_FILE = "map.npy"
+CHUNK_ROWS = 64
+
+
+def journal_dir(output: str | Path) -> Path:
+    output = Path(output)
+    return output.with_name(f"{output.name}.journal")
+
+
+def _checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLS_File.BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_journal(directory: Path) -> list[dict]:
+    # Entries up to the first incomplete line
+    entries = []
+    try:
+        with open(directory / JOURNAL_FILE, "r") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _append(directory: Path, entry: dict) -> None:
+    with open(directory / JOURNAL_FILE, "a") as file:
+        file.write(json.dumps(entry) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def checkpoint_map(output: str | Path, map_array: np.ndarray, settings: dict,
+                   origin: tuple[int, int] = (0, 0), halo: tuple[int, int, int, int] = (0, 0, 0, 0)) -> None:
+    # Starts a new journal for output with the finished map
+    # settings describe everything the map depends on, a resumed run must pass the same ones.
+    # origin and halo are those of a region, see MapGenerator.
+    directory = journal_dir(output)
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+
+    # int32 holds every field and halves the checkpoint
+    tmp = directory / f"{MAP_FILE}.tmp"
+    with open(tmp, "wb") as file:
+        np.save(file, map_array.astype(np.int32))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, directory / MAP_FILE)
+
+    _append(directory, {"map": {
+        "settings": settings,
+        "sha256": _file_checksum(directory / MAP_FILE),
+        "origin": list(origin),
+        "halo": list(halo),
+    }})
+
+
+def load_checkpoint(output: str | Path, settings: dict) -> tuple[np.ndarray, dict] | None:
+    # (map, map entry) of an interrupted save of output, or None if there is nothing to resume
+    # Raises ValueError when the journal belongs to other settings or its map is damaged.
+    directory = journal_dir(output)
+    entries = read_journal(directory)
+    if not entries or "map" not in entries[0]:
+        return None
+
+    entry = entries[0]["map"]
+    if entry["settings"] != settings:
+        changed = sorted(key for key in set(entry["settings"]) | set(settings)
+                         if entry["settings"].get(key) != settings.get(key))
+        raise ValueError(f"\"{directory}\" was written with other settings ({', '.join(changed)}), "
+                         f"delete it or run with the same settings.")
+
+    if _file_checksum(directory / MAP_FILE) != entry["sha256"]:
+        raise ValueError(f"The map checkpoint in \"{directory}\" is damaged, delete it to start over.")
+
+    return np.load(directory / MAP_FILE, mmap_mode="r"), entry
+
+
+def _verified_chunks(output: Path, entries: list[dict]) -> tuple[int, int, int, int]:
+    # (chunks, bytes, bricks, rows) of the journaled chunks the output still holds intact, in order
+    # The header is chunk 0, everything from the first missing or damaged chunk on is rewritten.
+    # rows is where the last intact chunk ends, whatever chunk size the journal was written with.
+    chunks = [entry.get("header") or entry.get("chunk") for entry in entries[1:]]
+    verified, end, bricks, rows = 0, 0, 0, 0
+
+    try:
+        file = open(output, "rb")
+    except FileNotFoundError:
+        return 0, 0, 0, 0
+
+    with file:
+        for chunk in chunks:
+            if chunk is None or chunk["offset"] != end:
+                break
+            file.seek(chunk["offset"])
+            if _checksum(file.read(chunk["bytes"])) != chunk["sha256"]:
+                break
+            if verified > 0 and chunk.get("rows", [0, 0])[0] != rows:
+                break
+            verified += 1
+            end += chunk["bytes"]
+            bricks = chunk.get("total_bricks", 0)
+            rows = chunk.get("rows", [0, 0])[1]
+
+    return verified, end, bricks, rows
+
+
+def write_resumable(map_array: np.ndarray, *, bricks, bl_id: str, colorset: str, output: str | Path,
+                    chunk_rows: int = CHUNK_ROWS, progress: Progress | None = None) -> dict:
+    # Writes the save from a map checkpointed with checkpoint_map, continuing after the last chunk
+    # the journal and the output agree on. Every chunk is synced before it is journaled.
+    # The journal is removed once the save is complete. Returns a summary of the run.
+    progress = progress or Progress()
+    output = Path(output)
+    directory = journal_dir(output)
+    entries = read_journal(directory)
+    if not entries or "map" not in entries[0]:
+        raise ValueError(f"\"{directory}\" has no map checkpoint.")
+
+    entry = entries[0]["map"]
+    top, bottom, left, right = entry["halo"]
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    inner = map_array[top:rows - bottom, left:cols - right]
+    formatter = BrickFormatter(bricks, bl_id, tuple(entry["origin"]))
+    newline = os.linesep
+
+    # The count comes from the map, so the header is right before a single brick is written
+    ids = np.arange(rows * cols).reshape(rows, cols)[top:rows - bottom, left:cols - right]
+    vbc = inner[:, :, VBC_INDEX]
+    brick_count = int(vbc[(inner[:, :, UBID_INDEX] == ids) & (vbc > 0)].sum(dtype=np.int64))
+
+    verified, offset, total_bricks, resumed_row = _verified_chunks(output, entries)
+    # Drop journal lines past the verified chunks, they are rewritten below
+    with open(directory / JOURNAL_FILE, "w") as file:
+        file.writelines(json.dumps(line) + "\n" for line in entries[:1 + verified])
+        file.flush()
+        os.fsync(file.fileno())
+
+    resumed_at = offset
+    # Chunks continue from the row the journal ends at, chunk_rows may differ from the interrupted run
+    starts = list(range(resumed_row, inner.shape[0], chunk_rows))
+    done_chunks = max(verified - 1, 0)
+
+    mode = "r+b" if output.exists() else "wb"
+    with open(output, mode) as file:
+        file.truncate(offset)
+        file.seek(offset)
+
+        # A header with another Linecount (or none) is replaced
+        if verified == 0:
+            header = _encode(BLS_File(bricks=[], brick_count=brick_count, colorset=colorset).data, newline)
+            file.write(header)
+            file.flush()
+            os.fsync(file.fileno())
+            _append(directory, {"header": {"offset": 0, "bytes": len(header), "sha256": _checksum(header),
+                                           "bricks": brick_count}})
+            offset = len(header)
+
+        progress.start("write", inner.shape[0])
+        progress.advance(resumed_row)
+        for start in starts:
+            band, band_bricks = render_rows(inner[start:start + chunk_rows], top + start, left, cols, formatter)
+            data = _encode("".join(band), newline)
+
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+            total_bricks += band_bricks
+            _append(directory, {"chunk": {"rows": [start, start + len(band)], "offset": offset, "bytes": len(data),
+                                          "sha256": _checksum(data), "bricks": band_bricks,
+                                          "total_bricks": total_bricks}})
+            offset += len(data)
+            progress.advance(len(band))
+        progress.finish()
+
+    if total_bricks != brick_count:
+        raise RuntimeError(f"Wrote {total_bricks} bricks, the header says {brick_count}.")
+
+    shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "bricks": brick_count,
+        "bytes": offset,
+        "resumed_at": resumed_at,
+        "chunks_verified": done_chunks,
+        "chunks_written": len(starts),
+    }
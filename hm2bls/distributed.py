@@ -0,0 +1,286 @@
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+
+import numpy as np
+
+from .blsutils import BLS_ColorSet, BLS_File
+from .engines import BrickFormatter, render_rows, row_costs
+from .progress import Progress
+from .schedule import plan_tiles
+
+# Work queue layout, everything lives in one directory shared by the coordinator and the workers:
+#   queue.json            settings, tile list and claim order, written last, workers start once it exists
+#   map.npy               the finished map array, memory mapped by the workers
+#   bricks.json           brick definitions
+#   pending/<tile>.json   tile jobs waiting for a worker
+#   claimed/<tile>.<worker>.json
+#                         tile jobs being rendered, a worker claims a job by renaming it here
+#   results/<tile>.bls    brick lines of a finished tile
+#   results/<tile>.json   brick count, worker and render time of a finished tile, written last,
+#                         marks the tile done
+# Renames within one directory tree are atomic, so two workers can never claim the same job.
+# Workers claim the tiles with the highest estimated cost first (see schedule.py), the cheap ones
+# are left for whoever runs out of work at the end.
+# Workers touch their claim while rendering; a claim that isn't touched for stale_after seconds
+# belongs to a dead worker and is moved back to pending/ by whoever notices first.
+QUEUE_FILE = "queue.json"
+MAP_FILE = "map.npy"
+BRICKS_FILE = "bricks.json"
+PENDING = "pending"
+CLAIMED = "claimed"
+RESULTS = "results"
+
+
+def tile_name(index: int) -> str:
+    return f"tile_{index:05d}"
+
+
+def worker_id() -> str:
+    # Unique across the nodes sharing the queue
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    # Readers only ever see complete files
+    tmp = path.with_name(f"{path.name}.{worker_id()}.tmp")
+    with open(tmp, "w") as file:
+        file.write(text)
+    os.replace(tmp, path)
+
+
+def claim(queue_dir: Path, worker: str, order: list[str] | None = None) -> Path | None:
+    # Claims the first pending job in order (tile names), or by name without one
+    # Returns its claim file or None if nothing is pending
+    pending = sorted((queue_dir / PENDING).glob("*.json"))
+    if order is not None:
+        by_tile = {job.stem: job for job in pending}
+        pending = [by_tile[tile] for tile in order if tile in by_tile]
+    for job in pending:
+        claimed = queue_dir / CLAIMED / f"{job.stem}.{worker}.json"
+        try:
+            os.rename(job, claimed)
+        except FileNotFoundError:
+            # Another worker was faster
+            continue
+        # rename keeps the job's mtime, the claim is fresh
+        os.utime(claimed)
+        return claimed
+    return None
+
+
+def requeue_stale(queue_dir: Path, stale_after: float) -> int:
+    # Moves claims that haven't been touched for stale_after seconds back to pending/
+    # Returns the number of requeued jobs
+    now = time.time()
+    requeued = 0
+    for claimed in (queue_dir / CLAIMED).glob("*.json"):
+        try:
+            if now - claimed.stat().st_mtime < stale_after:
+                continue
+            # Worker ids may contain dots, tile names don't
+            os.rename(claimed, queue_dir / PENDING / f"{claimed.name.split('.', 1)[0]}.json")
+        except FileNotFoundError:
+            # Finished or requeued in the meantime
+            continue
+        requeued += 1
+    return requeued
+
+
+def finished_tiles(queue_dir: Path) -> int:
+    return len(list((queue_dir / RESULTS).glob("*.json")))
+
+
+class _Heartbeat(threading.Thread):
+    # Touches a claim file at a fixed interval so it doesn't go stale while the tile renders
+    def __init__(self, path: Path, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.__stop = threading.Event()
+
+    def run(self) -> None:
+        while not self.__stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.join()
+
+
+def run_job(queue_dir: Path, claimed: Path, map_array: np.ndarray, cols: int,
+            formatter: BrickFormatter, worker: str) -> int:
+    # Renders one claimed tile into results/, returns its brick count
+    job = json.loads(claimed.read_text())
+    i0, i1 = job["rows"]
+    start = time.perf_counter()
+    rows, brick_count = render_rows(map_array[i0:i1], i0, 0, cols, formatter)
+    seconds = time.perf_counter() - start
+
+    results = queue_dir / RESULTS
+    _write_atomic(results / f"{job['tile']}.bls", "".join(rows))
+    _write_atomic(results / f"{job['tile']}.json", json.dumps({"bricks": brick_count, "worker": worker,
+                                                                "seconds": seconds}))
+    claimed.unlink(missing_ok=True)
+    return brick_count
+
+
+def run_worker(queue_dir: str | Path, poll: float = 0.5) -> int:
+    # Claims and renders tiles until every tile is done or the coordinator removes the queue
+    # Can run on any node that sees queue_dir. Returns the number of tiles this worker rendered.
+    from .generator import Bricks
+
+    queue_dir = Path(queue_dir)
+    queue_file = queue_dir / QUEUE_FILE
+    worker = worker_id()
+
+    while not queue_file.exists():
+        time.sleep(poll)
+
+    queue = json.loads(queue_file.read_text())
+    map_array = np.load(queue_dir / MAP_FILE, mmap_mode="r")
+    formatter = BrickFormatter(Bricks(queue_dir / BRICKS_FILE), queue["bl_id"])
+
+    rendered = 0
+    while queue_file.exists():
+        claimed = claim(queue_dir, worker, queue.get("order"))
+
+        if claimed is None:
+            if finished_tiles(queue_dir) >= len(queue["tiles"]):
+                break
+            requeue_stale(queue_dir, queue["stale_after"])
+            time.sleep(poll)
+            continue
+
+        heartbeat = _Heartbeat(claimed, queue["stale_after"] / 4)
+        heartbeat.start()
+        try:
+            run_job(queue_dir, claimed, map_array, queue["cols"], formatter, worker)
+        finally:
+            heartbeat.stop()
+        rendered += 1
+
+    return rendered
+
+
+def _start_worker(queue_dir: Path, poll: float) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=run_worker, args=(str(queue_dir), poll))
+    process.start()
+    return process
+
+
+def distribute(map_array: np.ndarray, *, bricks, bl_id: str, color_set: BLS_ColorSet,
+               output: str | Path, queue_dir: str | Path, tile_rows: int = 256, workers: int = 0,
+               stale_after: float = 60.0, poll: float = 0.5, progress: Progress | None = None) -> dict:
+    # Coordinator: queues one job per tile in queue_dir, waits for the workers and merges the
+    # tiles into output with the total Linecount
+    # workers local worker processes are started, more can join from other nodes with run_worker.
+    # A local worker that dies is replaced, its tile is requeued once its claim goes stale.
+    # Tiles are full width bands, so the merged save is identical to one written on a single machine.
+    progress = progress or Progress()
+    queue_dir = Path(queue_dir)
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    bounds, costs, order = plan_tiles(row_costs(map_array), tile_rows)
+    tiles = [tile_name(index) for index in range(len(bounds))]
+
+    # Start from an empty queue, leftovers of an earlier run would be merged otherwise
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    (queue_dir / QUEUE_FILE).unlink(missing_ok=True)
+    for sub in (PENDING, CLAIMED, RESULTS):
+        shutil.rmtree(queue_dir / sub, ignore_errors=True)
+        (queue_dir / sub).mkdir()
+
+    np.save(queue_dir / MAP_FILE, map_array)
+    with open(queue_dir / BRICKS_FILE, "w") as file:
+        json.dump(bricks.brick_data, file)
+
+    for tile, (i0, i1), cost in zip(tiles, bounds, costs.tolist()):
+        _write_atomic(queue_dir / PENDING / f"{tile}.json", json.dumps({"tile": tile, "rows": [i0, i1], "cost": cost}))
+
+    _write_atomic(queue_dir / QUEUE_FILE, json.dumps({
+        "rows": rows,
+        "cols": cols,
+        "bl_id": bl_id,
+        "stale_after": stale_after,
+        "tiles": tiles,
+        "order": [tiles[index] for index in order],
+    }))
+
+    started = time.perf_counter()
+    local = [_start_worker(queue_dir, poll) for _ in range(workers)]
+    restarts = 0
+
+    progress.start("tiles", len(tiles), "tiles")
+    finished = 0
+    try:
+        while finished < len(tiles):
+            requeue_stale(queue_dir, stale_after)
+
+            done = finished_tiles(queue_dir)
+            progress.advance(done - finished)
+            finished = done
+            if finished >= len(tiles):
+                break
+
+            # Local workers only exit with an error when they crash
+            for index, process in enumerate(local):
+                if process.is_alive() or process.exitcode == 0:
+                    continue
+                restarts += 1
+                if restarts > 3 * workers:
+                    raise RuntimeError(f"Local workers keep failing (exit code {process.exitcode}), giving up.")
+                local[index] = _start_worker(queue_dir, poll)
+
+            time.sleep(poll)
+        wall = time.perf_counter() - started
+    finally:
+        # Removing the queue file tells every worker to stop
+        (queue_dir / QUEUE_FILE).unlink(missing_ok=True)
+        for process in local:
+            process.join()
+    progress.finish()
+
+    # Merge in tile order
+    results = queue_dir / RESULTS
+    tile_results = [json.loads((results / f"{tile}.json").read_text()) for tile in tiles]
+    brick_count = sum(result["bricks"] for result in tile_results)
+    header = BLS_File(bricks=[], brick_count=brick_count, colorset=color_set.get_colorset()).data
+
+    with open(output, "w") as file:
+        file.write(header)
+        for tile in tiles:
+            with open(results / f"{tile}.bls", "r") as part:
+                shutil.copyfileobj(part, file, BLS_File.BUFFER_SIZE)
+
+    tiles_per_worker = {}
+    for result in tile_results:
+        tiles_per_worker[result["worker"]] = tiles_per_worker.get(result["worker"], 0) + 1
+
+    # Wall time includes polling, so efficiency is a lower bound for short runs
+    busy = sum(result["seconds"] for result in tile_results)
+    wall = max(wall, 1e-9)
+
+    # Only the queue's own files are removed, queue_dir may be shared with other things
+    for sub in (PENDING, CLAIMED, RESULTS):
+        shutil.rmtree(queue_dir / sub, ignore_errors=True)
+    (queue_dir / MAP_FILE).unlink(missing_ok=True)
+    (queue_dir / BRICKS_FILE).unlink(missing_ok=True)
+
+    return {
+        "tiles": len(tiles),
+        "bricks": brick_count,
+        "workers": tiles_per_worker,
+        "restarts": restarts,
+        "wall": wall,
+        "busy": busy,
+        "speedup": busy / wall,
+        "efficiency": busy / (wall * max(len(tiles_per_worker), 1)),
+    }
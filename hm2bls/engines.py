@@ -0,0 +1,910 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import math
+import os
+
+import numpy as np
+
+from .blsutils import (BLS_ColorSet, BLS_Brick, BLS_BrickShapeVec3, BLS_BrickData,
+                       BLS_BDFlags, BLS_OwnerData)
+from .maps import band_colors, crop, resize_colors
+from .progress import Progress
+from .schedule import TileRun, plan_tiles, tile_rows_for
+
+# Map elements (last axis of the map array):
+# [0] -> heightmap value
+# [1] -> color index
+# [2] -> unique brick index
+# [3] -> vertical brick count (0 for culled cells, they get no bricks)
+# [4] -> brick type (default is 0, the smaller brick)
+HEIGHT_INDEX = 0
+COLOR_INDEX  = 1
+UBID_INDEX   = 2
+VBC_INDEX    = 3
+BTYPE_INDEX  = 4
+
+FIELD_NAMES = ("height", "color", "unique brick index", "vertical brick count", "brick type")
+
+
+def make_brick_data(bl_id: str) -> BLS_BrickData:
+    # Owner data shared by every brick of a map
+    if bl_id != "-1":
+        return BLS_BrickData(BLS_BDFlags.OWNER, owner_data=BLS_OwnerData(int(bl_id)))
+    return BLS_BrickData()
+
+
+class ReferenceEngine:
+    # Per-cell Python loops, the original implementation of every stage
+    # Slow, but it defines the expected output the other engines are checked against.
+    name = "reference"
+
+    HEIGHT_INDEX = HEIGHT_INDEX
+    COLOR_INDEX  = COLOR_INDEX
+    UBID_INDEX   = UBID_INDEX
+    VBC_INDEX    = VBC_INDEX
+    BTYPE_INDEX  = BTYPE_INDEX
+
+    def __init__(self, progress: Progress | None = None, jobs: int | None = None) -> None:
+        self.progress = progress or Progress()
+        self.jobs = jobs
+        self.height_map = None
+        self.map = None
+
+    def map_colors(self, color_set: BLS_ColorSet, color_map: np.ndarray,
+                   shape: tuple[int, int] | None = None, window: tuple[int, int, int, int] | None = None) -> np.ndarray:
+        # Color indices of the map, resized to shape (rows, columns) if given and cut to window
+        # A color map smaller than the map is matched at its own size and only the indices are resized,
+        # one the size of the map is cut to the window before matching
+        if shape is None or color_map.shape[:2] == tuple(shape):
+            return self.match_colors(color_set, crop(color_map, window))
+        return resize_colors(self.match_colors(color_set, color_map), *shape, window=window)
+
+    def match_colors(self, color_set: BLS_ColorSet, color_map: np.ndarray) -> np.ndarray:
+        return color_set.map_colors(color_map=color_map, progress=self.progress)
+
+    def map_bands(self, color_set: BLS_ColorSet, height_map: np.ndarray, bands: dict,
+                  extrema: tuple[float, float] | None = None) -> np.ndarray:
+        # Color indices from height bands and slope instead of a color map, see maps.band_colors
+        # bands is a load_color_bands result, its RGBA colors are matched once like color map pixels
+        entries = [band["color"] for band in bands["bands"]]
+        if bands["slope"] is not None:
+            entries.append(bands["slope"]["color"])
+
+        rgba = [entry for entry in entries if isinstance(entry, list)]
+        matched = iter(self.match_colors(color_set, np.array([rgba], dtype=np.uint8)).reshape(-1).tolist() if rgba else [])
+        indices = [next(matched) if isinstance(entry, list) else entry for entry in entries]
+
+        count = len(bands["bands"])
+        return band_colors(height_map, [band["below"] for band in bands["bands"][:-1]], indices[:count],
+                           bands["slope"]["above"] if bands["slope"] is not None else None,
+                           indices[count] if bands["slope"] is not None else 0, extrema)
+
+    def setup_map(self, height_map: np.ndarray, color_map: np.ndarray, cull_mask: np.ndarray | None = None) -> None:
+        #creates a map containing useful data
+        self.height_map = height_map
+        self.map = np.zeros(shape=(height_map.shape[0], height_map.shape[1]), dtype=object)
+
+        unique_brick_index = 0
+
+        self.progress.start("setup_map", len(self.map))
+        for i in range(0, len(self.map)):
+            for j in range(0, len(self.map[i])):
+                culled = cull_mask is not None and cull_mask[i][j]
+                self.map[i][j] = [int(height_map[i][j]), int(color_map[i][j]), unique_brick_index, 0 if culled else 1, 0]
+                unique_brick_index += 1
+            self.progress.advance()
+        self.progress.finish()
+
+    def gap_fill(self, brick_height: float) -> None:
+        #Check adjacent bricks for vertical gaps
+        #Calculate amount of bricks needed to fill gap
+        hm = self.height_map
+        neighbor_offsets = [(-1,0),(1,0),(0,-1),(0,1)] #Up, down, left, right
+
+        self.progress.start("gap_fill", len(hm))
+        for i in range(0, len(hm)):
+            for j in range(0, len(hm[i])):
+                #Culled cells get no bricks and don't cause gaps in their neighbors
+                if self.map[i][j][self.VBC_INDEX] == 0:
+                    continue
+
+                largest_gap = 0
+
+                for offset_i, offset_j in neighbor_offsets:
+                    new_i = i + offset_i
+                    new_j = j + offset_j
+
+                    #Bounds check offsets
+                    if 0 <= new_i < len(hm) and 0 <= new_j < len(hm[i]) and \
+                       self.map[new_i][new_j][self.VBC_INDEX] != 0:
+
+                        if hm[i][j] > hm[new_i][new_j]:
+                            gap = float(hm[i][j]) - float(hm[new_i][new_j])
+
+                            if gap > brick_height:
+                                bricks_per_gap = math.ceil(gap / brick_height)
+                                largest_gap = max(largest_gap, bricks_per_gap)
+
+                if largest_gap > 0:
+                    self.map[i][j][self.VBC_INDEX] = largest_gap
+            self.progress.advance()
+        self.progress.finish()
+
+    def optimize(self) -> None:
+        #Tries to optimize brickcount by annulling adjacent bricks of the same height and color up to a 2x2 grid
+
+        seen = set()
+        self.progress.start("optimize", len(self.map)-1)
+        for i in range(len(self.map)-1):
+            for j in range(len(self.map[i])-1):
+                #Skip seen index, including next brick (Avoid corner clipping)
+                if self.map[i][j][self.UBID_INDEX] in seen or self.map[i][j+1][self.UBID_INDEX] in seen:
+                    continue
+
+                else:
+                    seen.add(self.map[i][j][self.UBID_INDEX])
+                    #Culled cells are never merged
+                    if self.map[i][j][self.VBC_INDEX] != 0 and self.map[i+1][j][self.VBC_INDEX] != 0 and \
+                       self.map[i][j+1][self.VBC_INDEX] != 0 and self.map[i+1][j+1][self.VBC_INDEX] != 0 and \
+                       len({self.map[i][j][self.HEIGHT_INDEX], self.map[i+1][j][self.HEIGHT_INDEX],
+                            self.map[i][j+1][self.HEIGHT_INDEX], self.map[i+1][j+1][self.HEIGHT_INDEX]}) == 1 and \
+                       len({self.map[i][j][self.COLOR_INDEX], self.map[i+1][j][self.COLOR_INDEX],
+                            self.map[i][j+1][self.COLOR_INDEX], self.map[i+1][j+1][self.COLOR_INDEX]}) == 1:
+
+                        #Overwrite unique index
+                        self.map[i+1][j][self.UBID_INDEX]   = self.map[i][j][self.UBID_INDEX]
+                        self.map[i][j+1][self.UBID_INDEX]   = self.map[i][j][self.UBID_INDEX]
+                        self.map[i+1][j+1][self.UBID_INDEX] = self.map[i][j][self.UBID_INDEX]
+
+                        #Overwrite vertical brick count
+                        largest_gap = max(self.map[i][j][self.VBC_INDEX], self.map[i+1][j][self.VBC_INDEX], self.map[i][j+1][self.VBC_INDEX], self.map[i+1][j+1][self.VBC_INDEX])
+                        self.map[i][j][self.VBC_INDEX]     = largest_gap
+                        self.map[i+1][j][self.VBC_INDEX]   = largest_gap
+                        self.map[i][j+1][self.VBC_INDEX]   = largest_gap
+                        self.map[i+1][j+1][self.VBC_INDEX] = largest_gap
+
+                        #Overwrite brick type
+                        self.map[i][j][self.BTYPE_INDEX]     = 1
+                        self.map[i+1][j][self.BTYPE_INDEX]   = 1
+                        self.map[i][j+1][self.BTYPE_INDEX]   = 1
+                        self.map[i+1][j+1][self.BTYPE_INDEX] = 1
+            self.progress.advance()
+        self.progress.finish()
+
+    def __make_brick(self, bricks, bl_id: str, index: int, color: int) -> BLS_Brick:
+        #Creates a brick using brick file data
+        shape = BLS_BrickShapeVec3(*bricks.brick_data["bricks"][index]["shape"])
+        ui_name =      bricks.brick_data["bricks"][index]["ui_name"]
+        is_baseplate = bricks.brick_data["bricks"][index]["is_baseplate"]
+        print_id =     bricks.brick_data["bricks"][index]["print_id"]
+        color_fx_id =  bricks.brick_data["bricks"][index]["color_fx_id"]
+        shape_fx_id =  bricks.brick_data["bricks"][index]["shape_fx_id"]
+        raycasting =   bricks.brick_data["bricks"][index]["raycasting"]
+        colliding =    bricks.brick_data["bricks"][index]["colliding"]
+        rendering =    bricks.brick_data["bricks"][index]["rendering"]
+
+        return BLS_Brick(brick_shape=shape,
+                         brick_ui_name=ui_name,
+                         is_baseplate=is_baseplate,
+                         color_id=color,
+                         print_id=print_id,
+                         color_fx_id=color_fx_id,
+                         shape_fx_id=shape_fx_id,
+                         raycasting=raycasting,
+                         colliding=colliding,
+                         rendering=rendering,
+                         brick_data=make_brick_data(bl_id)
+                         )
+
+    def create_rows(self, bricks, bl_id: str) -> tuple[list[str], int]:
+        #Make list of bricks to write, one string per map row
+        #Consumes the vertical brick counts, the map can't be saved twice
+        seen = set()
+        rows = []
+        brick_count = 0
+        brick_height = bricks.brick_data["bricks"][0]["shape"][2]
+
+        #Manual offsets for large bricks
+        x_offset = bricks.brick_data["bricks"][1]["offset"][0]
+        y_offset = bricks.brick_data["bricks"][1]["offset"][1]
+
+        self.progress.start("create_save", len(self.map))
+        for i in range(0, len(self.map)):
+            brick_row = ""
+
+            for j in range(0, len(self.map[i])):
+                if self.map[i][j][2] in seen:
+                    continue
+
+                else:
+
+                    for k in range(0, self.map[i][j][self.VBC_INDEX]):
+                        seen.add(self.map[i][j][self.UBID_INDEX])
+                        out_brick = self.__make_brick(bricks, bl_id, self.map[i][j][self.BTYPE_INDEX], self.map[i][j][self.COLOR_INDEX])
+
+                        #Choose brick type
+                        new_z = (self.map[i][j][self.HEIGHT_INDEX]-((self.map[i][j][self.VBC_INDEX] - 1) * brick_height))
+                        if self.map[i][j][self.BTYPE_INDEX] == 0:
+                            out_brick.set_pos(i, j, new_z)
+
+                        else:
+                            out_brick.set_pos_large(i, j, new_z, x_offset, y_offset)
+
+                        brick_row += out_brick.get_brick()
+                        brick_count += 1
+                        self.map[i][j][self.VBC_INDEX] -= 1
+
+            rows.append(brick_row)
+            self.progress.advance()
+        self.progress.finish()
+
+        return rows, brick_count
+
+    def stream_rows(self, bricks, bl_id: str) -> tuple[list[str], int]:
+        #Rows to write and the brick count, like create_rows
+        #Engines that can count bricks up front return rows that are rendered while they are written,
+        #the reference loop only knows the count once every row is done
+        return self.create_rows(bricks, bl_id)
+
+    # Metrics of the last render spread over processes (see schedule.TileRun.metrics), None if there was none
+    scaling = None
+
+    def map_array(self) -> np.ndarray:
+        # Map as a (rows, columns, 5) integer array, for comparing engines
+        return np.array(self.map.tolist(), dtype=np.int64).reshape(self.map.shape[0], self.map.shape[1], 5)
+
+
+class BrickFormatter:
+    # Renders brick lines without building BLS_Brick objects
+    # The constant parts of each brick type are rendered once and coordinates are cached per
+    # row/column/height, the output is identical to BLS_Brick.get_brick().
+    def __init__(self, bricks, bl_id: str, origin: tuple[int, int] = (0, 0)) -> None:
+        # origin is the world cell (row, column) of the map's first cell, for maps cut out of a larger one
+        data = make_brick_data(bl_id).get_data()
+        parts = bricks.line_parts()
+
+        self.brick_height = parts["shapes"][0][2]
+        self.shapes = [tuple(shape) for shape in parts["shapes"]]
+        self.prefixes = list(parts["prefixes"])
+        self.suffixes = [suffix + data for suffix in parts["suffixes"]]
+        self.offsets = [tuple(offset) for offset in parts["offsets"]]
+        self.middles = list(parts["middles"])
+        self.origin = origin
+        self.__x = ({}, {})
+        self.__y = ({}, {})
+        self.__z = ({}, {})
+
+    def x(self, btype: int, i: int) -> str:
+        cache = self.__x[btype]
+        if i not in cache:
+            # Same arithmetic as BLS_Brick.set_pos / set_pos_large
+            x = i + self.origin[0]
+            if btype == 0:
+                cache[i] = f"{float(round(self.shapes[0][0] * x / 2, 2)):.2f}"
+            else:
+                cache[i] = f"{float(round(self.shapes[1][0] / 2 * x / 2, 2)) + self.offsets[1][0]:.2f}"
+        return cache[i]
+
+    def y(self, btype: int, j: int) -> str:
+        cache = self.__y[btype]
+        if j not in cache:
+            y = j + self.origin[1]
+            if btype == 0:
+                cache[j] = f"{float(round(self.shapes[0][1] * y / 2, 2)):.2f}"
+            else:
+                cache[j] = f"{float(round(self.shapes[1][1] / 2 * y / 2, 2)) + self.offsets[1][1]:.2f}"
+        return cache[j]
+
+    def z(self, btype: int, z: int) -> str:
+        cache = self.__z[btype]
+        if z not in cache:
+            cache[z] = f"{float(round((self.shapes[btype][2] / 2 + z) / 5, 1)):.1f}"
+        return cache[z]
+
+    def line(self, btype: int, i: int, j: int, z: int, color: int) -> str:
+        return self.prefixes[btype] + self.x(btype, i) + " " + self.y(btype, j) + " " + self.z(btype, z) + \
+               self.middles[btype] + str(color) + self.suffixes[btype]
+
+
+def render_rows(block: np.ndarray, row0: int, col0: int, width: int, formatter: BrickFormatter,
+                progress: Progress | None = None) -> tuple[list[str], int]:
+    # Brick lines for a rectangular block of the map, one string per block row
+    # block is map[row0:row0+rows, col0:col0+cols] and width the width of the full map.
+    # A merged brick belongs to the block containing its top left cell, where the unique
+    # brick index equals the cell's own index. Doesn't modify the map.
+    rows = []
+    brick_count = 0
+    brick_height = formatter.brick_height
+    cols = np.arange(col0, col0 + block.shape[1])
+
+    for r in range(block.shape[0]):
+        i = row0 + r
+        row = block[r]
+        anchors = np.nonzero((row[:, UBID_INDEX] == i * width + cols) & (row[:, VBC_INDEX] > 0))[0]
+
+        parts = []
+        for j, height, color, count, btype in zip((anchors + col0).tolist(),
+                                                  row[anchors, HEIGHT_INDEX].tolist(),
+                                                  row[anchors, COLOR_INDEX].tolist(),
+                                                  row[anchors, VBC_INDEX].tolist(),
+                                                  row[anchors, BTYPE_INDEX].tolist()):
+            # Stacked bricks are written bottom to top
+            for k in range(count - 1, -1, -1):
+                parts.append(formatter.line(btype, i, j, height - k * brick_height, color))
+            brick_count += count
+
+        rows.append("".join(parts))
+        if progress is not None:
+            progress.advance()
+
+    return rows, brick_count
+
+
+def count_merges(map_array: np.ndarray) -> int:
+    # Number of merged 2x2 bricks in a (rows, columns, 5) map array
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    anchors = map_array[:, :, UBID_INDEX] == np.arange(rows * cols).reshape(rows, cols)
+    return int(np.count_nonzero(anchors & (map_array[:, :, BTYPE_INDEX] == 1) & (map_array[:, :, VBC_INDEX] > 0)))
+
+
+def row_costs(map_array: np.ndarray) -> np.ndarray:
+    # Estimated cost of rendering every row of a (rows, columns, 5) map array, in brick lines
+    # A line costs about as much as scanning a hundred cells, or a tenth of the per row overhead.
+    # The vertical brick counts are those of the finished map, so gap filled cliffs are accounted for.
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    vbc = map_array[:, :, VBC_INDEX]
+    anchors = (map_array[:, :, UBID_INDEX] == np.arange(rows * cols).reshape(rows, cols)) & (vbc > 0)
+    return np.where(anchors, vbc, 0).sum(axis=1, dtype=np.int64) + cols / 100 + 10
+
+
+class RowStream:
+    # Rows rendered on demand, with the number of rows known up front
+    def __init__(self, rows: int, iterator) -> None:
+        self.rows = rows
+        self.iterator = iterator
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __iter__(self):
+        return self.iterator
+
+
+def stream_region(map_array: np.ndarray, halo: tuple[int, int, int, int], formatter: BrickFormatter,
+                  band_rows: int = 64) -> tuple[RowStream, int]:
+    # Rows and brick count of a map without its halo (top, bottom, left, right), rendered band by band
+    # Halo cells are never merged, so every brick of the region is anchored inside it.
+    # The formatter's origin should be the world cell of the map's first cell, halo included.
+    top, bottom, left, right = halo
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    inner = map_array[top:rows - bottom, left:cols - right]
+
+    ids = np.arange(rows * cols).reshape(rows, cols)[top:rows - bottom, left:cols - right]
+    vbc = inner[:, :, VBC_INDEX]
+    brick_count = int(vbc[(inner[:, :, UBID_INDEX] == ids) & (vbc > 0)].sum(dtype=np.int64))
+
+    def region_rows():
+        for start in range(0, inner.shape[0], band_rows):
+            band, _ = render_rows(inner[start:start + band_rows], top + start, left, cols, formatter)
+            yield from band
+
+    return RowStream(inner.shape[0], region_rows()), brick_count
+
+
+def _render_band(block: np.ndarray, row0: int, width: int, formatter: BrickFormatter) -> tuple[list[str], int]:
+    # Process pool entry point
+    return render_rows(block, row0, 0, width, formatter)
+
+
+class NumpyEngine(ReferenceEngine):
+    # Whole-array numpy implementation, single threaded
+    # The map is a (rows, columns, 5) int32 array instead of an object array of lists.
+    name = "numpy"
+
+    # Rows rendered per batch when streaming
+    BAND_ROWS = 64
+
+    @staticmethod
+    def palette(color_set: BLS_ColorSet) -> tuple[np.ndarray, np.ndarray]:
+        # Colorset as a float64 (n, 4) array, plus the color index each entry maps to
+        return color_set.palette()
+
+    @staticmethod
+    def match_palette(colors: np.ndarray, palette: np.ndarray) -> np.ndarray:
+        # Index of the closest palette entry for each (n, 4) float64 color
+        # Same operation order as the reference loop, ties go to the first entry
+        best = np.zeros(len(colors), dtype=np.intp)
+        best_distance = np.full(len(colors), np.inf)
+
+        for index, (r, g, b, a) in enumerate(palette):
+            distance = np.square(colors[:, 0] - r)
+            distance += np.square(colors[:, 1] - g)
+            distance += np.square(colors[:, 2] - b)
+            distance += np.square(colors[:, 3] - a)
+            np.sqrt(distance, out=distance)
+
+            closer = distance < best_distance
+            best[closer] = index
+            best_distance[closer] = distance[closer]
+
+        return best
+
+    def unique_colors(self, color_map: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Distinct RGBA colors as (n, 4) float64 in 0-1, and the inverse index of every pixel
+        packed = np.ascontiguousarray(color_map, dtype=np.uint8).view(np.uint32).reshape(-1)
+        unique, inverse = np.unique(packed, return_inverse=True)
+        colors = unique.view(np.uint8).reshape(-1, 4).astype(np.float32) / 255
+        return colors.astype(np.float64), inverse
+
+    def match_colors(self, color_set: BLS_ColorSet, color_map: np.ndarray) -> np.ndarray:
+        # Matches each distinct color once instead of every pixel
+        self.progress.start("map_colors", 1, "steps")
+        palette, indices = self.palette(color_set)
+        colors, inverse = self.unique_colors(color_map)
+        best = self.match_palette(colors, palette)
+        self.progress.finish()
+        return indices[best][inverse].reshape(color_map.shape[0], color_map.shape[1])
+
+    def setup_map(self, height_map: np.ndarray, color_map: np.ndarray, cull_mask: np.ndarray | None = None) -> None:
+        rows, cols = height_map.shape[0], height_map.shape[1]
+        self.height_map = height_map
+
+        self.progress.start("setup_map", 1, "steps")
+        self.map = np.zeros((rows, cols, 5), dtype=np.int32)
+        self.map[:, :, HEIGHT_INDEX] = height_map
+        self.map[:, :, COLOR_INDEX] = color_map
+        self.map[:, :, UBID_INDEX] = np.arange(rows * cols, dtype=np.int32).reshape(rows, cols)
+        self.map[:, :, VBC_INDEX] = 1
+
+        if cull_mask is not None:
+            self.map[:, :, VBC_INDEX][cull_mask] = 0
+        self.progress.finish()
+
+    def gap_fill(self, brick_height: float) -> None:
+        # Largest gap towards the four neighbors, computed with shifted views of the whole map
+        heights = self.map[:, :, HEIGHT_INDEX].astype(np.float64)
+        live = self.map[:, :, VBC_INDEX] != 0
+        largest = np.zeros(heights.shape, dtype=np.int64)
+
+        self.progress.start("gap_fill", 4, "neighbors")
+        # (cell slice, neighbor slice) pairs for up, down, left, right
+        for cell, neighbor in (((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+                               ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+                               ((slice(None), slice(1, None)), (slice(None), slice(None, -1))),
+                               ((slice(None), slice(None, -1)), (slice(None), slice(1, None)))):
+            gap = heights[cell] - heights[neighbor]
+            valid = live[cell] & live[neighbor] & (gap > brick_height)
+            bricks_per_gap = np.where(valid, np.ceil(gap / brick_height), 0).astype(np.int64)
+            np.maximum(largest[cell], bricks_per_gap, out=largest[cell])
+            self.progress.advance()
+
+        fill = live & (largest > 0)
+        self.map[:, :, VBC_INDEX][fill] = largest[fill]
+        self.progress.finish()
+
+    def optimize(self) -> None:
+        # Same greedy 2x2 merge as the reference loop, one row at a time
+        # A cell is skipped by the reference when it is already part of a merged block, which is
+        # either the bottom half of a block anchored on the row above or the right half of a block
+        # anchored just to its left. So on every row, a block can be anchored at j when its four
+        # cells are live with one height and color and neither (i, j) nor (i, j+1) is covered from
+        # the row above. Within each run of such columns the greedy scan takes every other one.
+        rows, cols = self.map.shape[0], self.map.shape[1]
+        self.progress.start("optimize", rows - 1)
+        if rows < 2 or cols < 2:
+            self.progress.finish()
+            return
+
+        heights = self.map[:, :, HEIGHT_INDEX]
+        colors = self.map[:, :, COLOR_INDEX]
+        vbc = self.map[:, :, VBC_INDEX]
+        ubid = self.map[:, :, UBID_INDEX]
+        btype = self.map[:, :, BTYPE_INDEX]
+
+        # Blocks that could merge, indexed by their top left cell
+        # Merges never change heights or colors, and only change the counts of cells that are
+        # skipped afterwards, so this can be computed once up front
+        top_left = (slice(None, -1), slice(None, -1))
+        corners = ((slice(1, None), slice(None, -1)), (slice(None, -1), slice(1, None)), (slice(1, None), slice(1, None)))
+        uniform = vbc[top_left] != 0
+        for corner in corners:
+            uniform &= (vbc[corner] != 0) & (heights[corner] == heights[top_left]) & (colors[corner] == colors[top_left])
+
+        columns = np.arange(cols - 1)
+        covered = np.zeros(cols, dtype=bool)
+        for i in range(rows - 1):
+            candidates = uniform[i] & ~covered[:-1] & ~covered[1:]
+
+            # Offset of every column from the start of its run of candidates
+            starts = candidates.copy()
+            starts[1:] &= ~candidates[:-1]
+            run_start = np.maximum.accumulate(np.where(starts, columns, 0))
+            anchors = columns[candidates & ((columns - run_start) % 2 == 0)]
+
+            covered[:] = False
+            if len(anchors):
+                right = anchors + 1
+                largest = np.maximum(np.maximum(vbc[i, anchors], vbc[i, right]),
+                                     np.maximum(vbc[i + 1, anchors], vbc[i + 1, right]))
+                for row in (i, i + 1):
+                    for col in (anchors, right):
+                        ubid[row, col] = ubid[i, anchors]
+                        vbc[row, col] = largest
+                        btype[row, col] = 1
+                covered[anchors] = True
+                covered[right] = True
+            self.progress.advance()
+        self.progress.finish()
+
+    def create_rows(self, bricks, bl_id: str) -> tuple[list[str], int]:
+        formatter = BrickFormatter(bricks, bl_id)
+        self.progress.start("create_save", self.map.shape[0])
+        rows, brick_count = render_rows(self.map, 0, 0, self.map.shape[1], formatter, self.progress)
+        self.progress.finish()
+        return rows, brick_count
+
+    def brick_count(self) -> int:
+        # Bricks create_rows would write, without rendering them
+        rows, cols = self.map.shape[0], self.map.shape[1]
+        vbc = self.map[:, :, VBC_INDEX]
+        anchors = (self.map[:, :, UBID_INDEX] == np.arange(rows * cols).reshape(rows, cols)) & (vbc > 0)
+        return int(vbc[anchors].sum(dtype=np.int64))
+
+    def stream_rows(self, bricks, bl_id: str) -> tuple[RowStream, int]:
+        # The count comes from the map, so rows can be rendered band by band while they are written
+        formatter = BrickFormatter(bricks, bl_id)
+        rows_total, width = self.map.shape[0], self.map.shape[1]
+
+        def rows():
+            for start in range(0, rows_total, self.BAND_ROWS):
+                band_rows, _ = render_rows(self.map[start:start + self.BAND_ROWS], start, 0, width, formatter)
+                yield from band_rows
+
+        return RowStream(rows_total, rows()), self.brick_count()
+
+    def map_array(self) -> np.ndarray:
+        return self.map.astype(np.int64)
+
+
+class ParallelEngine(NumpyEngine):
+    # Numpy engine that spreads color matching over threads and brick rendering over processes
+    name = "parallel"
+
+    def match_colors(self, color_set: BLS_ColorSet, color_map: np.ndarray) -> np.ndarray:
+        palette, indices = self.palette(color_set)
+        colors, inverse = self.unique_colors(color_map)
+
+        jobs = self.jobs or os.cpu_count() or 1
+        chunks = np.array_split(colors, jobs)
+
+        self.progress.start("map_colors", len(chunks), "chunks")
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = []
+            for best in pool.map(lambda chunk: self.match_palette(chunk, palette), chunks):
+                results.append(best)
+                self.progress.advance()
+        self.progress.finish()
+
+        best = np.concatenate(results) if results else np.zeros(0, dtype=np.intp)
+        return indices[best][inverse].reshape(color_map.shape[0], color_map.shape[1])
+
+    def __tiles(self, pool: ProcessPoolExecutor, formatter: BrickFormatter) -> TileRun:
+        # Bands of rows sized for the number of workers, the most expensive ones submitted first
+        # (see schedule.py). Results come back in map order.
+        width = self.map.shape[1]
+        workers = self.jobs or os.cpu_count() or 1
+        bounds, costs, order = plan_tiles(row_costs(self.map), tile_rows_for(self.map.shape[0], workers, self.BAND_ROWS))
+        return TileRun(pool, workers, _render_band,
+                       lambda index: (self.map[bounds[index][0]:bounds[index][1]], bounds[index][0], width, formatter),
+                       bounds, costs, order)
+
+    def create_rows(self, bricks, bl_id: str) -> tuple[list[str], int]:
+        formatter = BrickFormatter(bricks, bl_id)
+
+        rows = []
+        brick_count = 0
+
+        self.progress.start("create_save", self.map.shape[0])
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            tiles = self.__tiles(pool, formatter)
+            for band_rows, band_count in tiles:
+                rows.extend(band_rows)
+                brick_count += band_count
+                self.progress.advance(len(band_rows))
+        self.progress.finish()
+        self.scaling = tiles.metrics()
+
+        return rows, brick_count
+
+    def stream_rows(self, bricks, bl_id: str) -> tuple[RowStream, int]:
+        formatter = BrickFormatter(bricks, bl_id)
+
+        def rows():
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                tiles = self.__tiles(pool, formatter)
+                # In map order, tiles that finish early wait for the ones before them
+                for band_rows, _ in tiles:
+                    yield from band_rows
+            self.scaling = tiles.metrics()
+
+        return RowStream(self.map.shape[0], rows()), self.brick_count()
+
+
+def _row_ends(keys: np.ndarray, cols: int) -> np.ndarray:
+    # End column (exclusive) of every interval, for sorted start keys (row * cols + column)
+    # that cover every row from column 0: an interval ends where the next one starts
+    rows = keys // cols
+    following = np.append(keys[1:], (rows[-1] + 1) * cols) if len(keys) else keys
+    return np.minimum(following - rows * cols, cols)
+
+
+def _subtract(a_starts: np.ndarray, a_ends: np.ndarray, b_starts: np.ndarray, b_ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Parts of the sorted, non overlapping intervals a that are outside every interval b
+    # Intervals of b may overlap. A part never spans two intervals of a.
+    if len(a_starts) == 0 or len(b_starts) == 0:
+        return a_starts, a_ends
+
+    points = np.unique(np.concatenate((a_starts, a_ends, b_starts, b_ends)))
+    starts, ends = points[:-1], points[1:]
+    in_a = np.searchsorted(a_starts, starts, "right") - np.searchsorted(a_ends, starts, "right") > 0
+    in_b = np.searchsorted(np.sort(b_starts), starts, "right") - np.searchsorted(np.sort(b_ends), starts, "right") > 0
+    keep = in_a & ~in_b
+    return starts[keep], ends[keep]
+
+
+class RleEngine(NumpyEngine):
+    # Stores every row as runs of cells with the same height, color and culling
+    # Flat areas cost one run instead of one entry per cell, so gap filling and merging scale with
+    # the number of runs rather than the number of cells:
+    # - runs: start key (row * columns + column), height, color, live
+    # - segments: runs split where the vertical brick count changes (gap filling only changes
+    #   it next to run boundaries), start key, run and count
+    # - merges: rows of 2x2 blocks found by optimize, as the key of the first anchor and the
+    #   number of anchors, which are every other column from there
+    # Rows of cells are only built for writing the save, and map_array() builds the full map
+    # for comparing engines. gap_fill has to run before optimize.
+    name = "rle"
+
+    def setup_map(self, height_map: np.ndarray, color_map: np.ndarray, cull_mask: np.ndarray | None = None) -> None:
+        rows, cols = height_map.shape[0], height_map.shape[1]
+        self.height_map = height_map
+        self.shape = (rows, cols)
+
+        self.progress.start("setup_map", 1, "steps")
+        heights = np.asarray(height_map).astype(np.int64)
+        colors = np.asarray(color_map).astype(np.int64)
+        live = ~np.asarray(cull_mask, dtype=bool) if cull_mask is not None else np.ones((rows, cols), dtype=bool)
+
+        # A run starts at every row start and wherever a cell differs from the one to its left
+        change = np.ones((rows, cols), dtype=bool)
+        change[:, 1:] = (heights[:, 1:] != heights[:, :-1]) | (colors[:, 1:] != colors[:, :-1]) | (live[:, 1:] != live[:, :-1])
+        self.run_key = np.flatnonzero(change)
+        self.run_height = heights.reshape(-1)[self.run_key]
+        self.run_color = colors.reshape(-1)[self.run_key]
+        self.run_live = live.reshape(-1)[self.run_key]
+
+        self.seg_key = self.run_key.copy()
+        self.seg_run = np.arange(len(self.run_key))
+        self.seg_vbc = self.run_live.astype(np.int64)
+
+        self.merge_key = np.zeros(0, dtype=np.int64)
+        self.merge_count = np.zeros(0, dtype=np.int64)
+        self.progress.finish()
+
+    def runs(self) -> int:
+        return len(self.run_key)
+
+    def __run_at(self, keys: np.ndarray) -> np.ndarray:
+        # Run containing each cell key
+        return np.searchsorted(self.run_key, keys, "right") - 1
+
+    def __seg_at(self, keys: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.seg_key, keys, "right") - 1
+
+    def gap_fill(self, brick_height: float) -> None:
+        # The count of a cell only depends on its own run and the runs of its four neighbours.
+        # Splitting the runs of each row at the run boundaries of the rows above and below, and
+        # cutting the first and last cell off every run, gives segments where all of those are the
+        # same for every cell, so the count is computed once per segment.
+        rows, cols = self.shape
+        self.progress.start("gap_fill", 1, "steps")
+        run_row = self.run_key // cols
+        run_length = _row_ends(self.run_key, cols) - self.run_key % cols
+        long_runs = run_length > 1
+
+        keys = np.unique(np.concatenate((
+            self.run_key,
+            self.run_key[long_runs] + 1,
+            self.run_key[long_runs] + run_length[long_runs] - 1,
+            self.run_key[run_row < rows - 1] + cols,
+            self.run_key[run_row > 0] - cols,
+        )))
+        row = keys // cols
+        start = keys % cols
+        end = _row_ends(keys, cols)
+
+        own = self.__run_at(keys)
+        heights = self.run_height[own].astype(np.float64)
+        live = self.run_live[own]
+        largest = np.zeros(len(keys), dtype=np.int64)
+
+        # Up, down, left (first cell) and right (last cell)
+        for neighbor, valid in ((keys - cols, row > 0),
+                                (keys + cols, row < rows - 1),
+                                (keys - 1, start > 0),
+                                (row * cols + end, end < cols)):
+            other = self.__run_at(np.where(valid, neighbor, 0))
+            gap = heights - self.run_height[other]
+            fill = valid & live & self.run_live[other] & (gap > brick_height)
+            np.maximum(largest, np.where(fill, np.ceil(gap / brick_height), 0).astype(np.int64), out=largest)
+
+        vbc = np.where(live, np.where(largest > 0, largest, 1), 0)
+
+        # Neighbouring segments of one run with the same count are joined again
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (own[1:] != own[:-1]) | (vbc[1:] != vbc[:-1])
+        self.seg_key = keys[first]
+        self.seg_run = own[first]
+        self.seg_vbc = vbc[first]
+        self.progress.finish()
+
+    def optimize(self) -> None:
+        # Same greedy 2x2 merge as NumpyEngine.optimize, with every set of columns kept as intervals
+        # Blocks of rows i and i+1 are uniform inside the intervals where both rows stay in one run
+        # with the same height and color. Row by row, the candidates are those intervals minus the
+        # columns next to cells merged from the row above, and each interval of candidates anchors
+        # a block at every other column, which covers one contiguous interval of the next row.
+        rows, cols = self.shape
+        self.progress.start("optimize", max(rows - 1, 0))
+        if rows < 2 or cols < 2:
+            self.progress.finish()
+            return
+
+        run_row = self.run_key // cols
+        keys = np.unique(np.concatenate((self.run_key[run_row < rows - 1], self.run_key[run_row > 0] - cols)))
+        end = _row_ends(keys, cols)
+        top = self.__run_at(keys)
+        bottom = self.__run_at(keys + cols)
+        uniform = self.run_live[top] & self.run_live[bottom] & \
+                  (self.run_height[top] == self.run_height[bottom]) & \
+                  (self.run_color[top] == self.run_color[bottom]) & \
+                  (end - keys % cols >= 2)
+
+        # Anchor columns j of uniform blocks, [start, end - 1)
+        uniform_key = keys[uniform]
+        uniform_end = end[uniform] - 1
+        bounds = np.searchsorted(uniform_key, np.arange(rows) * cols)
+
+        merge_keys = []
+        merge_counts = []
+        covered_starts = covered_ends = np.zeros(0, dtype=np.int64)
+        for i in range(rows - 1):
+            starts = uniform_key[bounds[i]:bounds[i + 1]] - i * cols
+            ends = uniform_end[bounds[i]:bounds[i + 1]]
+            starts, ends = _subtract(starts, ends, np.maximum(covered_starts - 1, 0), covered_ends)
+
+            count = (ends - starts + 1) // 2
+            merge_keys.append(starts + i * cols)
+            merge_counts.append(count)
+            covered_starts, covered_ends = starts, starts + 2 * count
+            self.progress.advance()
+
+        self.merge_key = np.concatenate(merge_keys)
+        self.merge_count = np.concatenate(merge_counts)
+        self.progress.finish()
+
+    def __anchors(self, merge_key: np.ndarray, merge_count: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Keys of the anchor cells of some merges, and the count of each merged brick
+        # (the largest count of its four cells)
+        cols = self.shape[1]
+        first = np.repeat(np.cumsum(merge_count) - merge_count, merge_count)
+        anchors = np.repeat(merge_key, merge_count) + 2 * (np.arange(int(merge_count.sum())) - first)
+        vbc = self.seg_vbc[self.__seg_at(anchors)]
+        for offset in (1, cols, cols + 1):
+            vbc = np.maximum(vbc, self.seg_vbc[self.__seg_at(anchors + offset)])
+        return anchors, vbc
+
+    def brick_count(self) -> int:
+        # Every live cell has its own bricks, except merged cells which share the anchor's
+        cols = self.shape[1]
+        seg_length = _row_ends(self.seg_key, cols) - self.seg_key % cols
+        total = int((self.seg_vbc * seg_length).sum())
+
+        anchors, vbc = self.__anchors(self.merge_key, self.merge_count)
+        for offset in (0, 1, cols, cols + 1):
+            total -= int(self.seg_vbc[self.__seg_at(anchors + offset)].sum())
+        return total + int(vbc.sum())
+
+    def map_array(self) -> np.ndarray:
+        rows, cols = self.shape
+        out = np.zeros((rows * cols, 5), dtype=np.int64)
+        run_length = _row_ends(self.run_key, cols) - self.run_key % cols
+        seg_length = _row_ends(self.seg_key, cols) - self.seg_key % cols
+
+        out[:, HEIGHT_INDEX] = np.repeat(self.run_height, run_length)
+        out[:, COLOR_INDEX] = np.repeat(self.run_color, run_length)
+        out[:, UBID_INDEX] = np.arange(rows * cols)
+        out[:, VBC_INDEX] = np.repeat(self.seg_vbc, seg_length)
+
+        anchors, vbc = self.__anchors(self.merge_key, self.merge_count)
+        for offset in (0, 1, cols, cols + 1):
+            out[anchors + offset, UBID_INDEX] = anchors
+            out[anchors + offset, VBC_INDEX] = vbc
+            out[anchors + offset, BTYPE_INDEX] = 1
+
+        return out.reshape(rows, cols, 5)
+
+    def __render_row(self, i: int, formatter: BrickFormatter, seg_bounds: np.ndarray, merge_bounds: np.ndarray) -> str:
+        # Brick lines of one row, built from its segments and the merges of this row and the one above
+        cols = self.shape[1]
+        row_key = i * cols
+
+        merge_key = self.merge_key[merge_bounds[i]:merge_bounds[i + 1]]
+        merge_count = self.merge_count[merge_bounds[i]:merge_bounds[i + 1]]
+        above_key = self.merge_key[merge_bounds[i - 1]:merge_bounds[i]] + cols if i > 0 else merge_key[:0]
+        above_count = self.merge_count[merge_bounds[i - 1]:merge_bounds[i]] if i > 0 else merge_count[:0]
+
+        covered_starts = np.concatenate((merge_key, above_key)) - row_key
+        covered_ends = covered_starts + 2 * np.concatenate((merge_count, above_count))
+
+        # Live cells that aren't part of a merged brick
+        seg_key = self.seg_key[seg_bounds[i]:seg_bounds[i + 1]]
+        live = self.seg_vbc[seg_bounds[i]:seg_bounds[i + 1]] > 0
+        starts = seg_key[live] - row_key
+        ends = _row_ends(seg_key, cols)[live]
+        starts, ends = _subtract(starts, ends, covered_starts, covered_ends)
+        length = ends - starts
+        single = np.repeat(starts, length) + np.arange(int(length.sum())) - np.repeat(np.cumsum(length) - length, length)
+        single_vbc = self.seg_vbc[self.__seg_at(single + row_key)]
+
+        anchors, anchor_vbc = self.__anchors(merge_key, merge_count)
+
+        columns = np.concatenate((single, anchors - row_key))
+        order = np.argsort(columns, kind="stable")
+        columns = columns[order]
+        btypes = np.concatenate((np.zeros(len(single), dtype=np.int64), np.ones(len(anchors), dtype=np.int64)))[order]
+        counts = np.concatenate((single_vbc, anchor_vbc))[order]
+        run = self.__run_at(columns + row_key)
+
+        parts = []
+        brick_height = formatter.brick_height
+        for j, height, color, count, btype in zip(columns.tolist(), self.run_height[run].tolist(), self.run_color[run].tolist(),
+                                                  counts.tolist(), btypes.tolist()):
+            # Stacked bricks are written bottom to top
+            for k in range(count - 1, -1, -1):
+                parts.append(formatter.line(btype, i, j, height - k * brick_height, color))
+        return "".join(parts)
+
+    def __rows(self, formatter: BrickFormatter):
+        rows, cols = self.shape
+        seg_bounds = np.searchsorted(self.seg_key, np.arange(rows + 1) * cols)
+        merge_bounds = np.searchsorted(self.merge_key, np.arange(rows + 1) * cols)
+        for i in range(rows):
+            yield self.__render_row(i, formatter, seg_bounds, merge_bounds)
+
+    def create_rows(self, bricks, bl_id: str) -> tuple[list[str], int]:
+        formatter = BrickFormatter(bricks, bl_id)
+        rows = []
+        self.progress.start("create_save", self.shape[0])
+        for row in self.__rows(formatter):
+            rows.append(row)
+            self.progress.advance()
+        self.progress.finish()
+        return rows, self.brick_count()
+
+    def stream_rows(self, bricks, bl_id: str) -> tuple[RowStream, int]:
+        return RowStream(self.shape[0], self.__rows(BrickFormatter(bricks, bl_id))), self.brick_count()
+
+
+ENGINES = {
+    ReferenceEngine.name: ReferenceEngine,
+    NumpyEngine.name:     NumpyEngine,
+    ParallelEngine.name:  ParallelEngine,
+    RleEngine.name:       RleEngine,
+}
+
+
+def get_engine(name: str, progress: Progress | None = None, jobs: int | None = None) -> ReferenceEngine:
+    # Creates an engine by name
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine \"{name}\", choose one of: {', '.join(ENGINES)}.")
+    return ENGINES[name](progress=progress, jobs=jobs)
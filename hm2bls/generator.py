@@ -0,0 +1,244 @@
+import asyncio
+import io
+import json
+
+import numpy as np
+
+from . import checkpoint, distributed, engines, maps, offsets, shards
+from .blsutils import BLS_ColorSet, BLS_File
+from .progress import Progress
+from .timer import timer
+
+
+class Bricks:
+    # Must follow structure of brickTemplate.json
+    brick_data: dict
+
+    @timer
+    def __init__(self, path: str) -> None:
+    # Load brick definitions from json file
+        path = str(path)
+        
+        if not path or not path.strip():
+            raise ValueError("Invalid brick file path.")
+
+        try:
+            with open(path, "r") as file:
+                self.brick_data = dict(json.load(file))
+            
+            if not isinstance(self.brick_data, dict):
+                raise ValueError(f"The JSON data in \"{path}\" must be a valid JSON.")
+        
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File \"{path}\" not found.")
+        
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON parsing error in \"{path}\": {e}")
+        
+        self.__line_parts = None
+    
+    @classmethod
+    def from_data(cls, brick_data: dict, line_parts: dict | None = None) -> "Bricks":
+        # Brick definitions that are already loaded, e.g. from a compiled artifact (see artifact.py)
+        bricks = cls.__new__(cls)
+        bricks.brick_data = brick_data
+        bricks.__line_parts = line_parts
+        return bricks
+    
+    def line_parts(self) -> dict:
+        # Constant text of a brick line for the small (0) and large (1) brick, built once
+        # The suffix ends with the newline, owner data goes after it. Used by engines.BrickFormatter.
+        if self.__line_parts is None:
+            brick_defs = self.brick_data["bricks"][:2]
+            self.__line_parts = {
+                "shapes": [list(brick["shape"]) for brick in brick_defs],
+                "offsets": [[0, 0], list(self.brick_data["bricks"][1]["offset"][:2])],
+                "prefixes": [f"{brick['ui_name']}\" " for brick in brick_defs],
+                "middles": [f" 0 {brick['is_baseplate']} " for brick in brick_defs],
+                "suffixes": [f" {brick['print_id']} {brick['color_fx_id']} {brick['shape_fx_id']} " +
+                             f"{brick['raycasting']} {brick['colliding']} {brick['rendering']}\n" for brick in brick_defs],
+            }
+        return self.__line_parts
+        
+
+        
+
+class MapGenerator:
+    # Map elements:
+    # [0] -> heightmap value
+    # [1] -> color index
+    # [2] -> unique brick index
+    # [3] -> vertical brick count (0 for culled cells, they get no bricks)
+    # [4] -> brick type (default is 0, the smaller brick)
+    HEIGHT_INDEX = engines.HEIGHT_INDEX
+    COLOR_INDEX  = engines.COLOR_INDEX
+    UBID_INDEX   = engines.UBID_INDEX
+    VBC_INDEX    = engines.VBC_INDEX
+    BTYPE_INDEX  = engines.BTYPE_INDEX
+    
+    def __init__(self,*, bricks: Bricks, 
+                 height_map: np.ndarray, 
+                 color_map: np.ndarray,
+                 bl_id: str,
+                 color_set: BLS_ColorSet,
+                 output_path: str | None = None,
+                 cull_mask: np.ndarray | None = None,
+                 progress: Progress | None = None,
+                 engine: str = "numpy",
+                 jobs: int | None = None,
+                 origin: tuple[int, int] = (0, 0),
+                 halo: tuple[int, int, int, int] = (0, 0, 0, 0)
+                 ) -> None:
+        # For a region of a larger map, origin is the world cell of the first map cell and halo the
+        # rows/columns on each side (top, bottom, left, right) that only give the edge cells their gaps
+        # output_path is only needed by the create_* methods, iter_save and write_to don't write files
+        
+        if not isinstance(height_map, np.ndarray):
+            raise TypeError("height_map must be a numpy array.")
+
+        if height_map.shape != color_map.shape:
+            raise ValueError("height_map and color_map must have the same shape.")
+
+        if cull_mask is not None and cull_mask.shape != height_map.shape:
+            raise ValueError("cull_mask must have the same shape as height_map.")
+
+        if output_path is not None and not str(output_path).strip():
+            raise ValueError("output_path must be a non-empty string.")
+
+        if not bl_id:
+            raise ValueError("bl_id must be a non-empty string.")
+
+        self.__bricks = bricks
+        self.__hm = height_map
+        self.__cm = color_map
+        self.__cull = cull_mask
+        self.__bl_id = bl_id
+        self.__color_set = color_set
+        self.__output_path = output_path
+        self.__progress = progress or Progress()
+        self.__jobs = jobs
+        self.__origin = tuple(origin)
+        self.__halo = tuple(halo)
+        # The engine holds the map and implements the stages
+        self.__engine = engines.get_engine(engine, progress=self.__progress, jobs=jobs)
+    
+    @property
+    def engine(self) -> engines.ReferenceEngine:
+        return self.__engine
+    
+    def map_array(self) -> np.ndarray:
+        # Current map as a (rows, columns, 5) integer array, see "Map elements" above
+        return self.__engine.map_array()
+    
+    @timer
+    def gap_fill(self) -> None:
+        #Check adjacent bricks for vertical gaps
+        #Calculate amount of bricks needed to fill gap
+        brick_height = self.__bricks.brick_data["bricks"][0]["shape"][2]
+        self.__engine.gap_fill(brick_height)
+
+    @timer
+    def optimize(self) -> None:
+        #Tries to optimize brickcount by annulling adjacent bricks of the same height and color up to a 2x2 grid
+        self.__engine.optimize()
+    
+    @timer
+    def setup_map(self) -> None:
+        #creates a map containing useful data
+        color_map = maps.exclude_halo(self.__cm, self.__halo) if any(self.__halo) else self.__cm
+        self.__engine.setup_map(self.__hm, color_map, self.__cull)
+    
+    def __save_file(self, buffer_size: int, direct: bool = False) -> BLS_File:
+        #Save with the bricks rendered while they are written where the engine supports it
+        if self.__is_region():
+            formatter = engines.BrickFormatter(self.__bricks, self.__bl_id, self.__origin)
+            bricks, brick_count = engines.stream_region(self.__engine.map_array(), self.__halo, formatter)
+        else:
+            bricks, brick_count = self.__engine.stream_rows(self.__bricks, self.__bl_id)
+        
+        return BLS_File(bricks=bricks, brick_count=brick_count, colorset=self.__color_set, progress=self.__progress,
+                        buffer_size=buffer_size, direct=direct)
+    
+    def __output(self) -> str:
+        if self.__output_path is None:
+            raise ValueError("output_path is needed to write a save file, use iter_save or write_to without one.")
+        return self.__output_path
+    
+    @timer
+    def create_save(self, buffer_size: int = BLS_File.BUFFER_SIZE, direct: bool = False) -> None:
+        #Make list of bricks to write, rendered while they are written where the engine supports it
+        #output_path can also be an open text file, e.g. sys.stdout
+        self.__save_file(buffer_size, direct).write(self.__output())
+    
+    def iter_save(self, chunk_bytes: int = BLS_File.BUFFER_SIZE, binary: bool = True):
+        #Yields the save as it is produced: the header, then chunks of about chunk_bytes
+        #Bricks are rendered when the next chunk is asked for, so a slow consumer holds the generator back
+        #Chunks are bytes with the same line endings create_save writes, or str with binary=False
+        yield from self.__save_file(chunk_bytes).chunks(binary)
+    
+    async def aiter_save(self, chunk_bytes: int = BLS_File.BUFFER_SIZE, binary: bool = True):
+        #iter_save for asyncio, every chunk is rendered on a worker thread so the event loop keeps running
+        chunks = self.iter_save(chunk_bytes, binary)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    
+    @timer
+    def write_to(self, fileobj, chunk_bytes: int = BLS_File.BUFFER_SIZE) -> int:
+        #Writes the save to an open file, buffer or socket and returns the number of bytes or characters written
+        #Text files (e.g. io.StringIO) get str, anything else bytes through sendall() or write()
+        binary = not isinstance(fileobj, io.TextIOBase)
+        send = getattr(fileobj, "sendall", None) or fileobj.write
+        
+        written = 0
+        for chunk in self.iter_save(chunk_bytes, binary):
+            send(chunk)
+            written += len(chunk)
+        return written
+    
+    @timer
+    def create_save_resumable(self, settings: dict) -> dict:
+        #Same save as create_save, journaled so an interrupted write can be resumed (see checkpoint.py)
+        #settings describe everything the map depends on. Returns a summary of the write
+        map_array = self.__engine.map_array()
+        checkpoint.checkpoint_map(self.__output(), map_array, settings, self.__origin, self.__halo)
+        return checkpoint.write_resumable(map_array, bricks=self.__bricks, bl_id=self.__bl_id,
+                                          colorset=self.__color_set.get_colorset(), output=self.__output(),
+                                          progress=self.__progress)
+    
+    def __is_region(self) -> bool:
+        return self.__origin != (0, 0) or any(self.__halo)
+    
+    def __whole_map_only(self, method: str) -> None:
+        if self.__is_region():
+            raise ValueError(f"{method} can't write a region, use create_save.")
+    
+    @timer
+    def create_save_parallel(self, band_rows: int = 64) -> dict:
+        #Same save as create_save, but bands of rows are rendered in parallel and written at their own offset
+        #Returns the file size, brick count and scaling of the write
+        self.__whole_map_only("create_save_parallel")
+        return offsets.write_at_offsets(self.__engine.map_array(), bricks=self.__bricks, bl_id=self.__bl_id,
+                                        colorset=self.__color_set.get_colorset(), path=self.__output(),
+                                        jobs=self.__jobs, band_rows=band_rows, progress=self.__progress)
+    
+    @timer
+    def create_shards(self, shard_size: int) -> dict:
+        #Writes one save per shard_size x shard_size region next to output_path, plus a manifest
+        #Returns the manifest
+        self.__whole_map_only("create_shards")
+        return shards.write_shards(self.__engine.map_array(), bricks=self.__bricks, bl_id=self.__bl_id,
+                                   color_set=self.__color_set, output=self.__output(),
+                                   shard_size=shard_size, jobs=self.__jobs, progress=self.__progress)
+    
+    @timer
+    def create_distributed(self, queue_dir: str, tile_rows: int = 256, workers: int = 0, stale_after: float = 60.0) -> dict:
+        #Renders the save as tiles through a work queue in queue_dir shared with worker processes, possibly on other machines
+        #Returns a summary of the run
+        self.__whole_map_only("create_distributed")
+        return distributed.distribute(self.__engine.map_array(), bricks=self.__bricks, bl_id=self.__bl_id,
+                                      color_set=self.__color_set, output=self.__output(), queue_dir=queue_dir,
+                                      tile_rows=tile_rows, workers=workers, stale_after=stale_after,
+                                      progress=self.__progress)
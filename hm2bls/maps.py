@@ -1,51 +1,181 @@
+from pathlib import Path
 from PIL import Image
 from .timer import timer
 import numpy as np
+import json
+import math
+import os
+
+# Raw height grids are memory mapped instead of decoded, with the dtype a suffix implies
+# .raw has no implied dtype and needs one passed in
+RAW_DTYPES = {
+    ".npy": None,
+    ".raw": None,
+    ".r16": "<u2",
+    ".r32": "<f4",
+}
+
+
+def is_raw(path) -> bool:
+    # Open files (e.g. stdin) are always images
+    return isinstance(path, (str, os.PathLike)) and Path(path).suffix.lower() in RAW_DTYPES
+
+
+def open_raw(path: str, shape: tuple[int, int] | None = None, dtype: str | None = None) -> np.ndarray:
+    # Memory maps a raw height grid read only, nothing is read until a stage touches the data
+    # .npy files carry their shape and dtype. Headerless grids (.raw, .r16, .r32) take dtype from
+    # the suffix unless given, and are assumed square when shape isn't given.
+    suffix = Path(path).suffix.lower()
+    
+    if suffix == ".npy":
+        grid = np.load(path, mmap_mode="r")
+        if grid.ndim != 2:
+            raise ValueError(f"\"{path}\" must hold a 2D grid, got shape {grid.shape}.")
+        return grid
+    
+    dtype = dtype or RAW_DTYPES.get(suffix)
+    if dtype is None:
+        raise ValueError(f"\"{path}\" has no dtype, pass one (e.g. uint16 or float32).")
+    
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError:
+        raise ValueError(f"Unknown raw dtype \"{dtype}\".")
+    
+    cells, rest = divmod(Path(path).stat().st_size, dtype.itemsize)
+    if shape is None:
+        side = math.isqrt(cells)
+        if rest or side * side != cells:
+            raise ValueError(f"\"{path}\" isn't a square {dtype} grid, pass its shape.")
+        shape = (side, side)
+    
+    if rest or shape[0] * shape[1] != cells:
+        raise ValueError(f"\"{path}\" holds {cells} {dtype} values, which doesn't match shape {shape[0]}x{shape[1]}.")
+    
+    return np.memmap(path, dtype=dtype, mode="r", shape=tuple(shape))
+
+
+def output_size(x: str | None, y: str | None, shape: tuple[int, int]) -> tuple[int, int]:
+    # (rows, columns) of a height map of shape (rows, columns) resized to -x and -y
+    # x is the number of rows (image height) and y the number of columns (image width),
+    # an axis without a size keeps the one it has
+    return int(x) if x is not None else shape[0], int(y) if y is not None else shape[1]
+
+
+def heightmap_size(path: str, x: str | None, y: str | None, raw_shape: tuple[int, int] | None = None,
+                   raw_dtype: str | None = None) -> tuple[int, int]:
+    # (rows, columns) load_heightmap will return, read from the image header without decoding
+    if x is not None and y is not None:
+        return int(x), int(y)
+    
+    if is_raw(path):
+        shape = open_raw(path, raw_shape, raw_dtype).shape
+    else:
+        with Image.open(path) as img:
+            shape = (img.height, img.width)
+    
+    return output_size(x, y, shape)
+
+def region_window(region: tuple[int, int, int, int], shape: tuple[int, int],
+                  halo: int = 1) -> tuple[tuple[int, int, int, int], tuple[int, int, int, int]]:
+    # Part of a map of shape (rows, columns) to load for region (x0, y0, x1, y1), x being rows and
+    # y columns like -x and -y, end exclusive
+    # Returns the window (row0, row1, col0, col1), grown by halo cells wherever the map goes on,
+    # and the halo it got on each side (top, bottom, left, right)
+    x0, y0, x1, y1 = region
+    rows, cols = shape
+    
+    if not (0 <= x0 < x1 <= rows and 0 <= y0 < y1 <= cols):
+        raise ValueError(f"region {x0},{y0},{x1},{y1} isn't inside the {rows}x{cols} map.")
+    
+    window = (max(x0 - halo, 0), min(x1 + halo, rows), max(y0 - halo, 0), min(y1 + halo, cols))
+    return window, (x0 - window[0], window[1] - x1, y0 - window[2], window[3] - y1)
+
+
+def crop(array: np.ndarray, window: tuple[int, int, int, int] | None) -> np.ndarray:
+    # array[row0:row1, col0:col1], or array itself without a window
+    if window is None:
+        return array
+    row0, row1, col0, col1 = window
+    return array[row0:row1, col0:col1]
+
+
+def _load_raw_heightmap(path: str, x: str | None, y: str | None, raw_shape: tuple[int, int] | None,
+                        raw_dtype: str | None, window: tuple[int, int, int, int] | None = None) -> np.ndarray:
+    # The memory map itself unless it has to be resized, heights keep their dtype and precision
+    # A window of the memory map only pages in the rows it covers
+    grid = open_raw(path, raw_shape, raw_dtype)
+    rows, cols = output_size(x, y, grid.shape)
+    
+    if (rows, cols) == grid.shape:
+        return crop(grid, window)
+    
+    img = Image.fromarray(np.asarray(grid, dtype=np.float32))
+    img = img.resize((cols, rows), Image.Resampling.BICUBIC)
+    return crop(np.asarray(img), window)
+
 
 @timer
-def load_heightmap(path: str, x: str | None, y: str | None) -> np.ndarray:
+def load_heightmap(path: str, x: str | None, y: str | None, raw_shape: tuple[int, int] | None = None,
+                   raw_dtype: str | None = None, window: tuple[int, int, int, int] | None = None) -> np.ndarray:
     # Loads image for heightmap, adds alpha channel and rescales to x,y
     # Returns red channel as height map
+    # Resizing and channel extraction happen on the PIL image to avoid full RGBA copies in numpy
+    # Raw grids (.npy, .raw, .r16, .r32) are memory mapped and returned as they are, see open_raw
+    # With a window (row0, row1, col0, col1) only that part of the resized map is returned, an
+    # image that isn't resized is cropped before it is converted
+    if is_raw(path):
+        return _load_raw_heightmap(path, x, y, raw_shape, raw_dtype, window)
+    
     with Image.open(path) as img:
-        img = img.convert("RGBA")
-        height_map: np.ndarray = np.array(img, dtype=np.uint8)
+        # Same size heightmap_size reports, so the color map is loaded at the right size
+        rows, cols = output_size(x, y, (img.height, img.width))
         
-        resize = False
-        new_size = []
+        if window is not None and (rows, cols) == (img.height, img.width):
+            row0, row1, col0, col1 = window
+            return np.array(img.crop((col0, row0, col1, row1)).convert("RGBA").getchannel("R"), dtype=np.uint8)
         
-        if x == None:
-            x = height_map.shape[1]
-        if y == None:
-            y = height_map.shape[0]
-
-        
-        if y != height_map.shape[0]:
-            new_size.append(int(y))
-            resize = True
-        else:
-            new_size.append(height_map.shape[0])
-        
-        if x != height_map.shape[1]:
-            new_size.append(int(x))
-            resize = True
-        else:
-            new_size.append(height_map.shape[1])
+        img = img.convert("RGBA")
         
-        if resize:
-            new_size = tuple(new_size)
-            height_map = Image.fromarray(height_map).resize(new_size, Image.Resampling.BICUBIC)
-            height_map = np.array(height_map)
+        if (rows, cols) != (img.height, img.width):
+            img = img.resize((cols, rows), Image.Resampling.BICUBIC)
             
         # Discards green, blue and alpha channels
-        height_map = height_map[:, :, :1].astype(np.uint32).squeeze(axis=2)
-    return height_map
+        height_map = np.array(img.getchannel("R"), dtype=np.uint8)
+    return crop(height_map, window)
+
 
 @timer
-def load_colormap(path: str, x: str | None, y: str | None) -> np.ndarray:
+def heightmap_extrema(path: str, x: str | None, y: str | None, raw_shape: tuple[int, int] | None = None,
+                      raw_dtype: str | None = None) -> tuple[float, float]:
+    # (min, max) of the whole height map load_heightmap returns, without keeping it
+    # -z and --ground scale a region by these so it gets the heights it has in the full map
+    if is_raw(path):
+        grid = _load_raw_heightmap(path, x, y, raw_shape, raw_dtype)
+        return grid.min().item(), grid.max().item()
+    
+    with Image.open(path) as img:
+        img = img.convert("RGBA")
+        rows, cols = output_size(x, y, (img.height, img.width))
+        if (rows, cols) != (img.height, img.width):
+            img = img.resize((cols, rows), Image.Resampling.BICUBIC)
+        return img.getchannel("R").getextrema()
+
+@timer
+def load_colormap(path: str, x: str | None, y: str | None, native: bool = False) -> np.ndarray:
     # Loads image for heightmap, adds alpha channel and rescales to x,y
     # Maintains color
+    # With native, a color map with fewer pixels than x*y is returned at its own size and a single
+    # color one as one pixel, map_colors matches those and resizes the indices instead
     with Image.open(path) as img:
         img = img.convert("RGBA")
+        
+        if native:
+            if all(low == high for low, high in img.getextrema()):
+                return np.array(img.crop((0, 0, 1, 1)), dtype=np.uint8)
+            if x is not None and y is not None and img.width * img.height < int(x) * int(y):
+                return np.array(img, dtype=np.uint8)
+        
         color_map: np.ndarray = np.array(img, dtype=np.uint8)
     
         resize = False
@@ -107,4 +237,299 @@ def ground(height_map: np.ndarray[np.uint32]) -> np.ndarray:
     # Lowers map to the ground
     min_val = height_map.min()
     height_map = (height_map - min_val)
-    return height_map.astype(np.uint32)
\ No newline at end of file
+    return height_map.astype(np.uint32)
+
+
+def _height_dtype(min_val: float, max_val: float) -> type:
+    # Narrowest dtype that can hold min_val to max_val, unsigned unless min_val is negative
+    # Raw grids can go below zero (terrain below sea level), an unsigned dtype would wrap those around
+    dtypes = (np.uint8, np.uint16, np.uint32, np.uint64) if min_val >= 0 else (np.int8, np.int16, np.int32, np.int64)
+    for dtype in dtypes[:-1]:
+        if np.iinfo(dtype).min <= min_val and max_val <= np.iinfo(dtype).max:
+            return dtype
+    return dtypes[-1]
+
+
+def _transform_chunk(chunk: np.ndarray, min_val, max_val, z: int | None, step: int | None) -> np.ndarray:
+    # Same arithmetic as resize_z followed by clamp_step, on a float64 chunk
+    chunk = chunk.astype(np.float64)
+    
+    if z is not None and max_val != min_val:
+        chunk -= min_val
+        chunk /= (max_val - min_val)
+        chunk *= z
+        chunk += min_val
+        np.trunc(chunk, out=chunk)
+    
+    if step is not None:
+        chunk /= step
+        np.round(chunk, out=chunk)
+        chunk *= step
+    
+    return chunk
+
+
+@timer
+def transform_heights(height_map: np.ndarray, z: str | None = None, step: str | None = None, 
+                      ground: bool = False, chunk_rows: int = 256,
+                      extrema: tuple[float, float] | None = None) -> np.ndarray:
+    # Fused resize_z -> clamp_step -> ground in a single chunked pass
+    # Gives the same heights as calling the three functions in that order, but only allocates
+    # one float64 chunk at a time and stores the result in the narrowest dtype that fits, a signed
+    # one when heights stay below zero (negative raw heights without ground).
+    # The input is overwritten when it already has that dtype, so pass a copy if you need to keep it.
+    # extrema are the (min, max) to scale by when height_map is a region of a larger map.
+    z = int(z) if z is not None else None
+    step = int(step) if step is not None and int(step) != 1 else None
+    
+    if z is None and step is None and not ground:
+        return height_map
+    
+    if extrema is not None:
+        min_val, max_val = (height_map.dtype.type(value) for value in extrema)
+    else:
+        min_val = height_map.min()
+        max_val = height_map.max()
+    
+    # Every stage is monotonic, so the extremes of the output come from the extremes of the input
+    bounds = _transform_chunk(np.array([min_val, max_val]), min_val, max_val, z, step)
+    offset = bounds[0] if ground else 0
+    dtype = _height_dtype(bounds[0] - offset, bounds[1] - offset)
+    
+    if height_map.dtype == dtype and height_map.flags.writeable:
+        out = height_map
+    else:
+        out = np.empty(height_map.shape, dtype=dtype)
+    
+    for start in range(0, height_map.shape[0], chunk_rows):
+        chunk = _transform_chunk(height_map[start:start + chunk_rows], min_val, max_val, z, step)
+        
+        if ground:
+            chunk -= offset
+        
+        out[start:start + chunk_rows] = chunk
+
+    return out
+
+
+def transform_extrema(extrema: tuple[float, float], z: str | None = None, step: str | None = None,
+                      ground: bool = False) -> tuple[float, float]:
+    # Lowest and highest height transform_heights gives a map with these (min, max)
+    bounds = transform_heights(np.array(extrema, dtype=np.float64), z=z, step=step, ground=ground, extrema=extrema)
+    return bounds[0].item(), bounds[1].item()
+
+
+# Built-in coloring for --color-bands without a file
+# Bands go from low to high, "below" is where a band ends as a fraction of the map's height range
+# and the last band goes to the top. Cells that rise more than "above" height steps per cell get
+# the slope color whatever their band. Colors are "#rrggbb" or "#rrggbbaa", matched to the
+# colorset like color map pixels, or colorset indices.
+DEFAULT_COLOR_BANDS = {
+    "bands": [
+        {"below": 0.08, "color": "#d8c88c"},  # sand
+        {"below": 0.55, "color": "#4c8c34"},  # grass
+        {"below": 0.85, "color": "#7c7468"},  # rock
+        {"color": "#f0f0f0"},                 # snow
+    ],
+    "slope": {"above": 3.0, "color": "#7c7468"},
+}
+
+
+def _band_color(value) -> int | list[int]:
+    # Colorset index, or RGBA values for a hex color
+    if isinstance(value, int) and not isinstance(value, bool):
+        if not 0 <= value < 64:
+            raise ValueError(f"color index {value} isn't in the colorset (0-63).")
+        return value
+    
+    text = str(value).lstrip("#")
+    if len(text) not in (6, 8):
+        raise ValueError(f"invalid color \"{value}\", use #rrggbb, #rrggbbaa or a colorset index.")
+    try:
+        rgba = [int(text[k:k + 2], 16) for k in range(0, len(text), 2)]
+    except ValueError:
+        raise ValueError(f"invalid color \"{value}\", use #rrggbb, #rrggbbaa or a colorset index.")
+    return rgba + [255] * (4 - len(rgba))
+
+
+def load_color_bands(path: str | None = None) -> dict:
+    # Height band coloring from a JSON file shaped like DEFAULT_COLOR_BANDS, or the built-in one
+    # Colors come back as colorset indices or RGBA lists
+    if path:
+        try:
+            with open(path, "r") as file:
+                spec = json.load(file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON parsing error in \"{path}\": {e}")
+    else:
+        spec = DEFAULT_COLOR_BANDS
+    
+    bands = spec.get("bands") if isinstance(spec, dict) else None
+    if not bands:
+        raise ValueError("color bands need a non-empty \"bands\" list.")
+    
+    levels = [band.get("below") for band in bands[:-1]]
+    if any(not isinstance(level, (int, float)) for level in levels) or levels != sorted(levels):
+        raise ValueError("every band but the last needs a \"below\" level, in increasing order.")
+    
+    slope = spec.get("slope")
+    if slope is not None and not isinstance(slope.get("above"), (int, float)):
+        raise ValueError("\"slope\" needs an \"above\" threshold.")
+    
+    return {
+        "bands": [{"below": band.get("below"), "color": _band_color(band.get("color"))} for band in bands],
+        "slope": {"above": float(slope["above"]), "color": _band_color(slope.get("color"))} if slope else None,
+    }
+
+
+@timer
+def band_colors(height_map: np.ndarray, levels: list[float], band_indices: list[int], slope: float | None = None,
+                slope_index: int = 0, extrema: tuple[float, float] | None = None) -> np.ndarray:
+    # Color index of every cell from the band its height falls in, or slope_index where the map rises
+    # more than slope height steps per cell
+    # levels are where every band but the last ends, as fractions of the range between extrema
+    # (the map's own lowest and highest height by default). One searchsorted finds every cell's
+    # band and the band colors are gathered from a lookup table.
+    low, high = extrema if extrema is not None else (height_map.min().item(), height_map.max().item())
+    thresholds = low + np.asarray(levels, dtype=np.float64) * (high - low)
+    colors = np.asarray(band_indices, dtype=np.uint8)[np.searchsorted(thresholds, height_map, side="right")]
+    
+    if slope is not None:
+        heights = np.asarray(height_map, dtype=np.float32)
+        rise = np.zeros(heights.shape, dtype=np.float32)
+        for axis in (0, 1):
+            if heights.shape[axis] > 1:
+                rise = np.hypot(rise, np.gradient(heights, axis=axis))
+        colors[rise > slope] = slope_index
+    
+    return colors
+
+
+def _smooth_within(heights: np.ndarray, max_error: int) -> np.ndarray:
+    # Rounded mean of the 3x3 neighbourhood, counting only neighbours at most max_error away
+    # Cliffs are left alone, and the result stays within max_error of every cell
+    rows, cols = heights.shape
+    padded = np.pad(heights, 1, mode="edge")
+    total = np.zeros(heights.shape, dtype=np.float64)
+    count = np.zeros(heights.shape, dtype=np.int64)
+
+    for di in range(3):
+        for dj in range(3):
+            neighbour = padded[di:di + rows, dj:dj + cols]
+            near = np.abs(neighbour - heights) <= max_error
+            total += np.where(near, neighbour, 0)
+            count += near
+
+    return np.rint(total / count)
+
+
+@timer
+def quantize_heights(height_map: np.ndarray, max_error: int, step: int | None = None) -> np.ndarray:
+    # Snaps near-equal neighbourhoods to shared heights, so optimize finds more uniform 2x2 blocks
+    # Heights are first smoothed without crossing edges larger than max_error, then quantized with
+    # hysteresis: along each row, and then down each column, a cell keeps the level of the cell
+    # before it as long as that level is within max_error of its own height.
+    # No height moves by more than max_error. With a step, heights stay multiples of it.
+    # Works on transformed heights (see transform_heights), returns a new array of the same dtype.
+    step = int(step) if step is not None else 1
+    max_error = int(max_error) // step
+
+    if max_error <= 0:
+        return height_map
+
+    heights = height_map.astype(np.int64) // step
+    smooth = _smooth_within(heights, max_error).astype(np.int64)
+
+    # Loops run over one axis with whole columns / rows at a time
+    levels = smooth.copy()
+    for j in range(1, levels.shape[1]):
+        keep = np.abs(heights[:, j] - levels[:, j - 1]) <= max_error
+        levels[keep, j] = levels[keep, j - 1]
+
+    for i in range(1, levels.shape[0]):
+        keep = np.abs(heights[i] - levels[i - 1]) <= max_error
+        levels[i, keep] = levels[i - 1, keep]
+
+    return (levels * step).astype(height_map.dtype)
+
+def level_size(shape: tuple[int, int], level: int) -> tuple[int, int]:
+    # (rows, columns) of a pyramid level whose longest side is `level` cells, keeping the aspect ratio
+    rows, cols = shape[0], shape[1]
+    scale = level / max(rows, cols)
+    return max(1, round(rows * scale)), max(1, round(cols * scale))
+
+
+def downsample_heights(height_map: np.ndarray, rows: int, cols: int) -> np.ndarray:
+    # Area-averages the heights down to rows x cols, keeping the input dtype
+    img = Image.fromarray(height_map.astype(np.float32))
+    img = img.resize((cols, rows), Image.Resampling.BOX)
+    return np.rint(np.asarray(img)).astype(height_map.dtype)
+
+
+def resize_colors(color_map: np.ndarray, rows: int, cols: int,
+                  window: tuple[int, int, int, int] | None = None) -> np.ndarray:
+    # Color indices can't be averaged or interpolated, so they are sampled with nearest neighbour
+    # window returns only that part of the resized map
+    if color_map.shape[:2] == (1, 1):
+        if window is not None:
+            rows, cols = window[1] - window[0], window[3] - window[2]
+        return np.full((rows, cols, *color_map.shape[2:]), color_map[0, 0], dtype=color_map.dtype)
+    img = Image.fromarray(color_map.astype(np.uint8))
+    img = img.resize((cols, rows), Image.Resampling.NEAREST)
+    return crop(np.asarray(img), window).astype(color_map.dtype)
+
+
+def exclude_halo(color_map: np.ndarray, halo: tuple[int, int, int, int]) -> np.ndarray:
+    # Copy of the color indices where the halo (top, bottom, left, right) has a color no cell has
+    # Halo cells only give the region's edge cells their gaps, this keeps them out of merges
+    top, bottom, left, right = halo
+    rows, cols = color_map.shape[0], color_map.shape[1]
+    colors = color_map.astype(np.int16)
+    colors[:top] = colors[rows - bottom:] = -1
+    colors[:, :left] = colors[:, cols - right:] = -1
+    return colors
+
+
+@timer
+def load_mask(path: str, rows: int, cols: int) -> np.ndarray:
+    # Loads a cull mask image resized to rows x cols (nearest neighbour, no blending at the edges)
+    # Black pixels mark culled cells, anything else is kept
+    with Image.open(path) as img:
+        img = img.convert("L")
+        if img.size != (cols, rows):
+            img = img.resize((cols, rows), Image.Resampling.NEAREST)
+        mask = np.asarray(img) == 0
+    return mask
+
+
+def cull_mask(*, color_map: np.ndarray | None = None, mask: np.ndarray | None = None,
+              height_map: np.ndarray | None = None, sea_level: float | None = None,
+              shape: tuple[int, int] | None = None, window: tuple[int, int, int, int] | None = None) -> np.ndarray | None:
+    # Combines the culling sources into one boolean array (True = no brick for that cell)
+    # color_map must be the RGBA color map (cells with alpha 0 are culled), a smaller one is
+    # resized to the height map with nearest neighbour like its colors,
+    # sea_level is compared to the untransformed height map values (cells below it are culled).
+    # When height_map is the window of a map of the given shape, color_map and mask still cover the whole map.
+    # Returns None when nothing is culled.
+    culled = None
+    shape = shape or (height_map.shape[:2] if height_map is not None else None)
+    
+    if color_map is not None:
+        culled = color_map[:, :, 3] == 0
+        if shape is not None and culled.shape != tuple(shape):
+            culled = resize_colors(culled, *shape, window=window)
+        else:
+            culled = crop(culled, window)
+    
+    if mask is not None:
+        mask = crop(mask, window)
+        culled = mask.copy() if culled is None else (culled | mask)
+    
+    if height_map is not None and sea_level is not None:
+        below = height_map < sea_level
+        culled = below if culled is None else (culled | below)
+    
+    if culled is not None and not culled.any():
+        return None
+    
+    return culled
@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import os
+
+import numpy as np
+
+from .blsutils import BLS_File
+from .engines import BrickFormatter, render_rows, row_costs, HEIGHT_INDEX, COLOR_INDEX, UBID_INDEX, VBC_INDEX, BTYPE_INDEX
+from .progress import Progress
+from .schedule import TileRun, plan_tiles, tile_rows_for
+
+
+def _encode(text: str, newline: str) -> bytes:
+    # Same bytes a text mode file would write
+    if newline != "\n":
+        text = text.replace("\n", newline)
+    return text.encode()
+
+
+def _lengths(values: np.ndarray, length) -> np.ndarray:
+    # length(value) for every value, computed once per distinct value
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([length(value) for value in unique.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+
+
+def band_sizes(map_array: np.ndarray, formatter: BrickFormatter, band_rows: int,
+               newline: str = os.linesep) -> tuple[list[int], list[int]]:
+    # Exact byte size and brick count of every band of band_rows rows, without rendering a line
+    # A brick line is constant text plus its x, y, z and color fields, so its length is the
+    # constant length plus the length of each field, which is looked up per distinct value.
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    extra = len(newline) - 1
+    brick_height = formatter.brick_height
+
+    constant = []
+    for btype in (0, 1):
+        text = formatter.prefixes[btype] + formatter.middles[btype] + formatter.suffixes[btype]
+        # Two spaces between x, y and z
+        constant.append(len(text.encode()) + 2 + extra * text.count("\n"))
+    constant = np.array(constant, dtype=np.int64)
+
+    x_length = np.array([[len(formatter.x(btype, i)) for i in range(rows)] for btype in (0, 1)], dtype=np.int64)
+    y_length = np.array([[len(formatter.y(btype, j)) for j in range(cols)] for btype in (0, 1)], dtype=np.int64)
+
+    sizes = []
+    counts = []
+    for start in range(0, rows, band_rows):
+        block = map_array[start:start + band_rows]
+        ids = np.arange(start, start + block.shape[0])[:, None] * cols + np.arange(cols)
+        anchors = (block[:, :, UBID_INDEX] == ids) & (block[:, :, VBC_INDEX] > 0)
+        anchor_i, anchor_j = np.nonzero(anchors)
+        cells = block[anchors]
+
+        # One entry per brick, stacked bricks go down from the cell's height
+        count = cells[:, VBC_INDEX].astype(np.int64)
+        total = int(count.sum())
+        first = np.repeat(np.cumsum(count) - count, count)
+        k = np.arange(total) - first
+        i = np.repeat(anchor_i + start, count)
+        j = np.repeat(anchor_j, count)
+        btype = np.repeat(cells[:, BTYPE_INDEX], count)
+        z = np.repeat(cells[:, HEIGHT_INDEX].astype(np.int64), count) - k * brick_height
+        color = np.repeat(cells[:, COLOR_INDEX], count)
+
+        length = constant[btype] + x_length[btype, i] + y_length[btype, j]
+        length += _lengths(color, lambda value: len(str(value)))
+        for b in (0, 1):
+            typed = btype == b
+            if typed.any():
+                length[typed] += _lengths(z[typed], lambda value: len(formatter.z(b, value)))
+
+        sizes.append(int(length.sum()))
+        counts.append(total)
+
+    return sizes, counts
+
+
+def write_band(path: str, block: np.ndarray, row0: int, width: int, formatter: BrickFormatter,
+               offset: int, size: int, newline: str) -> int:
+    # Renders one band and writes it at its offset, runs in a worker process
+    # Returns the brick count
+    rows, brick_count = render_rows(block, row0, 0, width, formatter)
+    data = _encode("".join(rows), newline)
+
+    if len(data) != size:
+        raise RuntimeError(f"Band at row {row0} is {len(data)} bytes, {size} were reserved for it.")
+
+    fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    try:
+        view = memoryview(data)
+        written = 0
+        while written < size:
+            if hasattr(os, "pwrite"):
+                written += os.pwrite(fd, view[written:], offset + written)
+            else:
+                # No pwrite on Windows, the descriptor is this process' own so seeking is safe
+                os.lseek(fd, offset + written, os.SEEK_SET)
+                written += os.write(fd, view[written:])
+    finally:
+        os.close(fd)
+
+    return brick_count
+
+
+def write_at_offsets(map_array: np.ndarray, *, bricks, bl_id: str, colorset: str, path: str | Path,
+                     jobs: int | None = None, band_rows: int = 64, progress: Progress | None = None) -> dict:
+    # Writes the save with every band rendered and written in parallel at its own offset
+    # Band sizes are computed up front, the file is preallocated and each worker writes its band
+    # straight into it, so nothing is collected or copied by this process.
+    # Bands are at most band_rows rows, smaller on small maps so every worker gets several, and the
+    # most expensive ones are rendered first (see schedule.py).
+    # The save is identical to the one BLS_File writes. Returns the file size, the brick count and
+    # the scaling of the run (see schedule.TileRun.metrics).
+    progress = progress or Progress()
+    path = str(path)
+    newline = os.linesep
+    formatter = BrickFormatter(bricks, bl_id)
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    workers = jobs or os.cpu_count() or 1
+    band_rows = tile_rows_for(rows, workers, band_rows)
+
+    sizes, counts = band_sizes(map_array, formatter, band_rows, newline)
+    brick_count = sum(counts)
+    header = _encode(BLS_File(bricks=[], brick_count=brick_count, colorset=colorset).data, newline)
+    offsets = np.cumsum([len(header)] + sizes).tolist()
+    total = offsets[-1]
+
+    with open(path, "wb") as file:
+        file.write(header)
+        file.truncate(total)
+        if hasattr(os, "posix_fallocate") and total > 0:
+            try:
+                os.posix_fallocate(file.fileno(), 0, total)
+            except OSError:
+                # Not supported by every filesystem, the file just stays sparse
+                pass
+    print(f"Header done, ready to write {brick_count} bricks...")
+
+    bounds, costs, order = plan_tiles(row_costs(map_array), band_rows)
+    progress.start("write", rows)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        tiles = TileRun(pool, workers, write_band,
+                        lambda index: (path, map_array[bounds[index][0]:bounds[index][1]], bounds[index][0], cols,
+                                       formatter, offsets[index], sizes[index], newline),
+                        bounds, costs, order)
+        for (i0, i1), _ in zip(bounds, tiles):
+            progress.advance(i1 - i0)
+    progress.finish()
+
+    return {"bytes": total, "bricks": brick_count, "scaling": tiles.metrics()}
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
+
+from .profiling import Profiler
+
+
+class Stage:
+    # A named step of the pipeline
+    # func is called with the results of its dependencies, in the order they are listed
+    def __init__(self, name: str, func, deps: tuple[str, ...] = (), message: str | None = None) -> None:
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.message = message
+
+
+class Pipeline:
+    # Small dependency graph of stages executed on a thread pool
+    # Stages start as soon as everything they depend on is done, so independent branches
+    # (e.g. heightmap decoding and colormap matching) overlap. Pillow decoding and most numpy
+    # work release the GIL, which is where the overlap pays off.
+    def __init__(self, max_workers: int | None = None, profiler: Profiler | None = None) -> None:
+        self.max_workers = max_workers
+        self.profiler = profiler or Profiler()
+        self.stages: dict[str, Stage] = {}
+        self.timings: dict[str, float] = {}
+
+    def add(self, name: str, func, deps: tuple[str, ...] = (), message: str | None = None) -> None:
+        if name in self.stages:
+            raise ValueError(f"Stage \"{name}\" is already defined.")
+
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage \"{name}\" depends on unknown stage \"{dep}\".")
+
+        self.stages[name] = Stage(name, func, deps, message)
+
+    def __run_stage(self, stage: Stage, args: list) -> object:
+        if stage.message:
+            print(f"{stage.message}\n", end="")
+
+        start_time = time.perf_counter()
+        with self.profiler.profile(stage.name):
+            result = stage.func(*args)
+        self.timings[stage.name] = time.perf_counter() - start_time
+        return result
+
+    def run(self) -> dict[str, object]:
+        # Runs every stage and returns their results by name
+        # The first exception raised by a stage is re-raised once running stages are done
+        results: dict[str, object] = {}
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # Stages are added in dependency order, so this keeps submission order stable
+                for name, stage in list(pending.items()):
+                    if all(dep in results for dep in stage.deps):
+                        args = [results[dep] for dep in stage.deps]
+                        running[pool.submit(self.__run_stage, stage, args)] = name
+                        del pending[name]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+
+                    if error is not None:
+                        for other in running:
+                            other.cancel()
+                        raise error
+
+                    results[name] = future.result()
+
+        return results
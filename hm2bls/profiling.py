@@ -0,0 +1,192 @@
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+import cProfile
+import pstats
+import sys
+import threading
+
+
+class Profiler:
+    # Profiles each pipeline stage separately
+    # Stages run inside `with profiler.profile("stage"):`.
+    # This base class profiles nothing, see StageProfiler.
+    @contextmanager
+    def profile(self, stage: str):
+        yield
+
+    def written(self) -> list[Path]:
+        return []
+
+
+def _label(code_or_func) -> str:
+    # Frame label for collapsed stacks, ';' separates frames so it can't appear in one
+    if isinstance(code_or_func, tuple):
+        filename, line, name = code_or_func
+    else:
+        filename, line, name = code_or_func.co_filename, code_or_func.co_firstlineno, code_or_func.co_name
+
+    if filename == "~":
+        # Built-in functions, e.g. "<built-in method builtins.len>"
+        return name.replace(";", ":")
+    return f"{name} ({Path(filename).name}:{line})".replace(";", ":")
+
+
+def _caller_dag(raw: dict) -> tuple[dict, list]:
+    # Caller graph of cProfile data without cycles, and its functions with callers before callees
+    # A depth first walk up the callers drops every edge back to a function still on the walk
+    # (recursion), so each function's paths only depend on functions finished before it.
+    callers = {}
+    order = []
+    for root in raw:
+        if root in callers:
+            continue
+        callers[root] = []
+        walk = [(root, iter(raw[root][4]))]
+        on_walk = {root}
+        while walk:
+            func, pending = walk[-1]
+            for caller in pending:
+                if caller in on_walk:
+                    continue
+                callers[func].append(caller)
+                if caller not in callers:
+                    callers[caller] = []
+                    walk.append((caller, iter(raw[caller][4] if caller in raw else ())))
+                    on_walk.add(caller)
+                    break
+            else:
+                walk.pop()
+                on_walk.discard(func)
+                order.append(func)
+    return callers, order
+
+
+def collapse_pstats(stats: pstats.Stats, max_depth: int = 64, max_paths: int = 32) -> Counter:
+    # Approximates collapsed stacks ("a;b;c microseconds") from cProfile data
+    # cProfile only records caller -> callee edges, so the own time of a function is split
+    # over its call paths in proportion to the cumulative time of each caller edge.
+    # Paths are built once per function, callers first, keeping the max_paths heaviest paths of
+    # at most max_depth callers each, so this is linear in the number of caller edges.
+    raw = stats.stats
+    callers, order = _caller_dag(raw)
+    paths = {}
+
+    for func in order:
+        edges = {caller: raw[func][4][caller][3] for caller in callers[func]}
+        total = sum(edges.values())
+
+        if total <= 0:
+            paths[func] = [((_label(func),), 1.0)]
+            continue
+
+        label = (_label(func),)
+        result = []
+        for caller, cumulative in edges.items():
+            share = cumulative / total
+            for path, fraction in paths[caller]:
+                result.append(((path + label)[-(max_depth + 1):], fraction * share))
+        # Keep the heaviest paths, the rest is noise in a flamegraph
+        result.sort(key=lambda item: item[1], reverse=True)
+        paths[func] = result[:max_paths]
+
+    stacks = Counter()
+    for func, (_, _, own_time, _, _) in raw.items():
+        if own_time <= 0:
+            continue
+        for path, fraction in paths[func]:
+            weight = int(own_time * fraction * 1_000_000)
+            if weight > 0:
+                stacks[";".join(path)] += weight
+
+    return stacks
+
+
+def write_collapsed(stacks: Counter, path: Path) -> None:
+    with open(path, "w") as file:
+        for stack, weight in sorted(stacks.items()):
+            file.write(f"{stack} {weight}\n")
+
+
+class _Sampler(threading.Thread):
+    # Samples the stack of one thread at a fixed interval
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.__stop = threading.Event()
+
+    def run(self) -> None:
+        while not self.__stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.join()
+
+
+class StageProfiler(Profiler):
+    # Writes <directory>/<stage>.pstats and <directory>/<stage>.collapsed for every stage
+    # mode "cprofile" traces every call (exact counts, noticeable overhead), the collapsed
+    # stacks are reconstructed from the call graph.
+    # mode "sample" samples the stage's stack every `interval` seconds, which costs little
+    # even on very long jobs; it writes collapsed stacks only (weights are sample counts).
+    # .collapsed files can be fed to flamegraph.pl, speedscope, inferno, etc.
+    MODES = ("cprofile", "sample")
+
+    def __init__(self, directory: str | Path, mode: str = "cprofile", interval: float = 0.005) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profile mode \"{mode}\", choose one of: {', '.join(self.MODES)}.")
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.interval = interval
+        self.__written = []
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, stage: str):
+        if self.mode == "sample":
+            sampler = _Sampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self.__write(stage, sampler.stacks, None)
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                stats = pstats.Stats(profile)
+                self.__write(stage, collapse_pstats(stats), stats)
+
+    def __write(self, stage: str, stacks: Counter, stats: pstats.Stats | None) -> None:
+        with self.__lock:
+            if stats is not None:
+                pstats_path = self.directory / f"{stage}.pstats"
+                stats.dump_stats(pstats_path)
+                self.__written.append(pstats_path)
+
+            collapsed_path = self.directory / f"{stage}.collapsed"
+            write_collapsed(stacks, collapsed_path)
+            self.__written.append(collapsed_path)
+
+    def written(self) -> list[Path]:
+        return list(self.__written)
@@ -0,0 +1,154 @@
+import json
+import sys
+import time
+
+
+class Progress:
+    # Observer for long running stages
+    # Stages call start() once, advance() per row/tile and finish() when they are done.
+    # advance() only reads the clock every `stride` calls and only emits every `interval`
+    # seconds, so calling it once per row costs next to nothing.
+    # This base class reports nothing, subclasses override emit().
+    def __init__(self, interval: float = 0.25) -> None:
+        self.interval = interval
+        self.stage = ""
+        self.unit = "rows"
+        self.total = 0
+        self.done = 0
+        self.start_time = 0.0
+        self.__last_emit = 0.0
+        self.__next_check = 0
+        self.__stride = 1
+
+    def start(self, stage: str, total: int, unit: str = "rows") -> None:
+        self.stage = stage
+        self.unit = unit
+        self.total = int(total)
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.__last_emit = self.start_time
+        # Check the clock at most ~1000 times per stage
+        self.__stride = max(1, self.total // 1000)
+        self.__next_check = self.__stride
+        self.emit("start")
+
+    def advance(self, n: int = 1) -> None:
+        self.done += n
+
+        if self.done >= self.__next_check:
+            self.__next_check = self.done + self.__stride
+            now = time.monotonic()
+
+            if now - self.__last_emit >= self.interval:
+                self.__last_emit = now
+                self.emit("update")
+
+    def finish(self) -> None:
+        self.done = max(self.done, self.total)
+        self.emit("finish")
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    @property
+    def rate(self) -> float:
+        # Units per second
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        # Seconds left, None until there is enough data to guess
+        rate = self.rate
+        if rate <= 0 or self.total <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    @property
+    def fraction(self) -> float:
+        if self.total <= 0:
+            return 1.0
+        return min(self.done / self.total, 1.0)
+
+    def emit(self, event: str) -> None:
+        pass
+
+
+def _format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+class ProgressBar(Progress):
+    # Single line CLI progress bar with throughput and ETA
+    def __init__(self, stream=None, width: int = 30, interval: float = 0.1) -> None:
+        super().__init__(interval=interval)
+        self.stream = stream if stream is not None else sys.stderr
+        self.width = width
+
+    def emit(self, event: str) -> None:
+        filled = int(self.fraction * self.width)
+        bar = "#" * filled + "." * (self.width - filled)
+
+        if event == "finish":
+            timing = f"{_format_seconds(self.elapsed)} total"
+        else:
+            timing = f"ETA {_format_seconds(self.eta)}"
+
+        line = f"\r{self.stage:<12} [{bar}] {self.fraction:6.1%} {self.done}/{self.total} {self.unit} " + \
+               f"{self.rate:,.0f} {self.unit}/s {timing}  "
+        self.stream.write(line)
+
+        if event == "finish":
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+class JsonProgress(Progress):
+    # One JSON object per line, meant for machine consumers
+    def __init__(self, stream=None, interval: float = 1.0) -> None:
+        super().__init__(interval=interval)
+        self.stream = stream if stream is not None else sys.stderr
+
+    def emit(self, event: str) -> None:
+        eta = self.eta
+        record = {
+            "time": time.time(),
+            "event": event,
+            "stage": self.stage,
+            "unit": self.unit,
+            "done": self.done,
+            "total": self.total,
+            "elapsed": round(self.elapsed, 4),
+            "rate": round(self.rate, 2),
+            "eta": round(eta, 2) if eta is not None else None,
+        }
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+
+class CallbackProgress(Progress):
+    # Forwards every emitted event to callback(progress, event), e.g. to update a GUI
+    def __init__(self, callback, interval: float = 0.1) -> None:
+        super().__init__(interval=interval)
+        self.callback = callback
+
+    def emit(self, event: str) -> None:
+        self.callback(self, event)
+
+
+def make_progress(kind: str, stream=None) -> Progress:
+    # Builds a progress observer from a CLI name
+    if kind == "bar":
+        return ProgressBar(stream)
+    if kind == "json":
+        return JsonProgress(stream)
+    if kind == "none":
+        return Progress()
+    raise ValueError(f"Unknown progress kind \"{kind}\".")
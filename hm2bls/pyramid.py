@@ -0,0 +1,70 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .blsutils import BLS_ColorSet
+from .generator import Bricks, MapGenerator
+from .maps import level_size, downsample_heights, resize_colors, transform_heights, quantize_heights
+
+
+def level_path(output: str, level: int) -> Path:
+    # out/map.bls -> out/map_256.bls
+    output = Path(output)
+    return output.with_name(f"{output.stem}_{level}{output.suffix}")
+
+
+def generate_level(*, level: int, height_map: np.ndarray, color_map: np.ndarray,
+                   color_set: BLS_ColorSet, bricks: Bricks, bl_id: str, output: str,
+                   z: int | None, step: int | None, ground: bool,
+                   gapfill: bool, optimize: bool, cull_mask: np.ndarray | None = None,
+                   engine: str = "numpy", quantize: int | None = None) -> str:
+    # Builds and writes one pyramid level, runs in a worker process
+    rows, cols = level_size(height_map.shape, level)
+
+    level_heights = downsample_heights(height_map, rows, cols)
+    level_colors = resize_colors(color_map, rows, cols)
+    level_heights = transform_heights(level_heights, z=z, step=step, ground=ground)
+    
+    if quantize:
+        level_heights = quantize_heights(level_heights, quantize, step=step)
+    
+    if cull_mask is not None:
+        cull_mask = resize_colors(cull_mask.view(np.uint8), rows, cols).astype(bool)
+
+    map = MapGenerator(bricks=bricks, height_map=level_heights,
+                       color_map=level_colors, bl_id=bl_id,
+                       color_set=color_set, output_path=output,
+                       cull_mask=cull_mask, engine=engine)
+    map.setup_map()
+
+    if gapfill:
+        map.gap_fill()
+
+    if optimize:
+        map.optimize()
+
+    map.create_save()
+    return output
+
+
+def generate_pyramid(*, levels: list[int], height_map: np.ndarray, color_map: np.ndarray,
+                     output: str, jobs: int | None = None, **settings) -> list[str]:
+    # Writes one save per level from the same decoded and colour mapped full resolution arrays
+    # Levels are area-downsampled from the source, so every level must be at most the source size.
+    # settings are passed through to generate_level (color_set, bricks, bl_id, z, step, ...)
+    largest = max(height_map.shape)
+    for level in levels:
+        if level > largest:
+            raise ValueError(f"Pyramid level {level} is larger than the source ({largest} cells).")
+
+    # Largest levels first, they take the longest
+    levels = sorted(set(levels), reverse=True)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(generate_level, level=level, height_map=height_map, color_map=color_map,
+                               output=str(level_path(output, level)), **settings)
+                   for level in levels]
+        paths = [future.result() for future in futures]
+
+    return paths
@@ -0,0 +1,95 @@
+from concurrent.futures import Executor
+import os
+import threading
+import time
+
+import numpy as np
+
+# Tiles of rows for the process pools that render bricks
+# Rendering a row costs a scan of its cells plus one line per brick, and gap filled cliffs stack
+# many bricks on a cell where flat or culled rows have one or none, so equal bands of rows can
+# differ by orders of magnitude. Tiles are kept small (several per worker) and submitted from the
+# most to the least expensive estimate: every idle worker takes the next tile from the pool's
+# shared queue, so the expensive tiles start first and the cheap ones fill the gaps at the end.
+# Results are still handed out in map order, the save doesn't depend on the schedule.
+TILES_PER_WORKER = 4
+MIN_TILE_ROWS = 8
+
+
+def tile_rows_for(rows: int, jobs: int | None, max_rows: int) -> int:
+    # Rows per tile so every worker gets about TILES_PER_WORKER tiles, between MIN_TILE_ROWS and max_rows
+    jobs = jobs or os.cpu_count() or 1
+    return max(min(rows // (jobs * TILES_PER_WORKER), max_rows), min(MIN_TILE_ROWS, max_rows), 1)
+
+
+def plan_tiles(row_costs: np.ndarray, tile_rows: int) -> tuple[list[tuple[int, int]], np.ndarray, list[int]]:
+    # (row bounds of every tile in map order, estimated cost of every tile, tile indices largest first)
+    # row_costs is the estimated cost of every row, see engines.row_costs
+    rows = len(row_costs)
+    bounds = [(i0, min(i0 + tile_rows, rows)) for i0 in range(0, rows, tile_rows)]
+    costs = np.add.reduceat(row_costs, [i0 for i0, _ in bounds]) if bounds else np.zeros(0)
+    # Stable, so equal tiles keep map order
+    order = np.argsort(-costs, kind="stable").tolist()
+    return bounds, costs, order
+
+
+def timed(func, *args):
+    # (func(*args), seconds it took), runs in a worker process
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class TileRun:
+    # Tiles submitted to a pool largest first, results iterated in map order
+    # args(index) returns the arguments of func for a tile. Iterating yields func's results,
+    # metrics() describes how well the run used the workers once every result is in.
+    def __init__(self, pool: Executor, workers: int, func, args, bounds: list[tuple[int, int]],
+                 costs: np.ndarray, order: list[int]) -> None:
+        self.workers = max(min(workers, len(bounds)), 1)
+        self.bounds = bounds
+        self.costs = costs
+        self.__busy = 0.0
+        self.__finished = 0.0
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+
+        futures = {}
+        for index in order:
+            futures[index] = pool.submit(timed, func, *args(index))
+            futures[index].add_done_callback(self.__done)
+        self.__futures = [futures[index] for index in range(len(bounds))]
+
+    def __done(self, future) -> None:
+        with self.__lock:
+            self.__finished = max(self.__finished, time.perf_counter())
+
+    def __iter__(self):
+        for future in self.__futures:
+            result, seconds = future.result()
+            self.__busy += seconds
+            yield result
+
+    def metrics(self) -> dict:
+        # Scaling of the run: wall time from the first submission to the last finished tile,
+        # time the workers spent rendering, and how much of workers x wall time that is
+        wall = max(self.__finished - self.__start, 1e-9)
+        mean = float(self.costs.mean()) if len(self.costs) else 0.0
+        return {
+            "tiles": len(self.bounds),
+            "tile_rows": self.bounds[0][1] - self.bounds[0][0] if self.bounds else 0,
+            "workers": self.workers,
+            "wall": wall,
+            "busy": self.__busy,
+            "speedup": self.__busy / wall,
+            "efficiency": self.__busy / (wall * self.workers),
+            # Most expensive tile against the average, how uneven the map is
+            "imbalance": float(self.costs.max()) / mean if mean > 0 else 1.0,
+        }
+
+
+def describe_scaling(metrics: dict) -> str:
+    return (f"{metrics['tiles']} tiles of {metrics['tile_rows']} rows on {metrics['workers']} workers: "
+            f"{metrics['busy']:.2f}s of work in {metrics['wall']:.2f}s, "
+            f"{metrics['speedup']:.2f}x speedup, {metrics['efficiency']:.0%} efficiency "
+            f"(costliest tile {metrics['imbalance']:.1f}x the average)")
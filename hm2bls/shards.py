@@ -0,0 +1,97 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+
+from .blsutils import BLS_ColorSet, BLS_File
+from .engines import BrickFormatter, render_rows
+from .progress import Progress
+
+
+def shard_bounds(rows: int, cols: int, size: int) -> list[tuple[int, int, int, int]]:
+    # (row start, row end, column start, column end) of every size x size region, in map order
+    return [(i0, min(i0 + size, rows), j0, min(j0 + size, cols))
+            for i0 in range(0, rows, size)
+            for j0 in range(0, cols, size)]
+
+
+def shard_path(output: str | Path, row: int, col: int) -> Path:
+    # out/map.bls -> out/map_<row>_<col>.bls
+    output = Path(output)
+    return output.with_name(f"{output.stem}_{row}_{col}{output.suffix}")
+
+
+def manifest_path(output: str | Path) -> Path:
+    # out/map.bls -> out/map.manifest.json
+    output = Path(output)
+    return output.with_name(f"{output.stem}.manifest.json")
+
+
+def write_shard(block: np.ndarray, bounds: tuple[int, int, int, int], width: int,
+                formatter: BrickFormatter, colorset: str, path: str) -> tuple[int, int]:
+    # Renders and writes one shard, runs in a worker process
+    # Returns (brick count, bytes written), empty shards aren't written
+    i0, _, j0, _ = bounds
+    rows, brick_count = render_rows(block, i0, j0, width, formatter)
+
+    if brick_count == 0:
+        return 0, 0
+
+    BLS_File(bricks=rows, brick_count=brick_count, colorset=colorset).write(path)
+    return brick_count, os.path.getsize(path)
+
+
+def write_shards(map_array: np.ndarray, *, bricks, bl_id: str, color_set: BLS_ColorSet,
+                 output: str | Path, shard_size: int, jobs: int | None = None,
+                 progress: Progress | None = None) -> dict:
+    # Splits the map into shard_size x shard_size regions and writes one save per region, plus a manifest
+    # Every shard has its own Linecount and the full colorset, and keeps the world coordinates of
+    # the full map. A merged brick belongs to the shard that contains its top left cell.
+    progress = progress or Progress()
+    formatter = BrickFormatter(bricks, bl_id)
+    colorset = color_set.get_colorset()
+    rows, cols = map_array.shape[0], map_array.shape[1]
+    bounds = shard_bounds(rows, cols, shard_size)
+
+    shards = []
+    progress.start("shards", len(bounds), "shards")
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for i0, i1, j0, j1 in bounds:
+            path = shard_path(output, i0 // shard_size, j0 // shard_size)
+            futures.append((path, (i0, i1, j0, j1),
+                            pool.submit(write_shard, map_array[i0:i1, j0:j1], (i0, i1, j0, j1),
+                                        cols, formatter, colorset, str(path))))
+
+        for path, (i0, i1, j0, j1), future in futures:
+            brick_count, size = future.result()
+            progress.advance()
+
+            if brick_count == 0:
+                continue
+
+            shards.append({
+                "file": path.name,
+                "row": i0 // shard_size,
+                "col": j0 // shard_size,
+                "bounds": {"rows": [i0, i1], "cols": [j0, j1]},
+                "bricks": brick_count,
+                "bytes": size,
+            })
+    progress.finish()
+
+    manifest = {
+        "shard_size": shard_size,
+        "rows": rows,
+        "cols": cols,
+        "bricks": sum(shard["bricks"] for shard in shards),
+        "bytes": sum(shard["bytes"] for shard in shards),
+        "shards": shards,
+    }
+
+    with open(manifest_path(output), "w") as file:
+        json.dump(manifest, file, indent=4)
+
+    return manifest
@@ -6,6 +6,7 @@ def timer(func):
         res = func(*args, **kwargs)
         end_time = time.time()
         exec_time = end_time - start_time
-        print(f"-> Done in {exec_time:.4f} seconds")
+        # Single write so lines from concurrent stages don't interleave
+        print(f"-> Done in {exec_time:.4f} seconds\n", end="")
         return res
     return wrapper
\ No newline at end of file
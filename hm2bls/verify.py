@@ -0,0 +1,125 @@
+from dataclasses import dataclass, field
+import time
+
+import numpy as np
+
+from .blsutils import BLS_ColorSet
+from .engines import FIELD_NAMES, get_engine
+
+
+@dataclass
+class StageResult:
+    stage: str
+    time_a: float
+    time_b: float
+    # Description of the first difference, None when the outputs match
+    divergence: str | None = None
+
+    @property
+    def speedup(self) -> float:
+        # How many times faster engine b was than engine a
+        return self.time_a / self.time_b if self.time_b > 0 else float("inf")
+
+
+@dataclass
+class VerifyReport:
+    engine_a: str
+    engine_b: str
+    stages: list[StageResult] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return all(stage.divergence is None for stage in self.stages)
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<12} {self.engine_a:>12} {self.engine_b:>12} {'speedup':>9}  result"]
+        for stage in self.stages:
+            result = "match" if stage.divergence is None else f"DIVERGES: {stage.divergence}"
+            lines.append(f"{stage.stage:<12} {stage.time_a:>11.4f}s {stage.time_b:>11.4f}s {stage.speedup:>8.1f}x  {result}")
+        return "\n".join(lines)
+
+
+def first_array_divergence(a: np.ndarray, b: np.ndarray) -> str | None:
+    # First differing element of two color index arrays
+    if a.shape != b.shape:
+        return f"shape {a.shape} != {b.shape}"
+
+    diff = np.argwhere(a != b)
+    if len(diff) == 0:
+        return None
+
+    i, j = diff[0][:2]
+    return f"cell ({i}, {j}): {a[i, j]} != {b[i, j]}"
+
+
+def first_map_divergence(a: np.ndarray, b: np.ndarray) -> str | None:
+    # First differing element of two (rows, columns, 5) map arrays
+    if a.shape != b.shape:
+        return f"shape {a.shape} != {b.shape}"
+
+    diff = np.argwhere(a != b)
+    if len(diff) == 0:
+        return None
+
+    i, j, k = diff[0]
+    return f"cell ({i}, {j}) {FIELD_NAMES[k]}: {a[i, j, k]} != {b[i, j, k]}"
+
+
+def first_record_divergence(rows_a: list[str], count_a: int, rows_b: list[str], count_b: int) -> str | None:
+    # Compares the brick section of two saves line by line
+    records_a = "".join(rows_a).splitlines()
+    records_b = "".join(rows_b).splitlines()
+
+    for number, (record_a, record_b) in enumerate(zip(records_a, records_b), start=1):
+        if record_a != record_b:
+            return f"record {number}: \"{record_a}\" != \"{record_b}\""
+
+    if len(records_a) != len(records_b):
+        return f"{len(records_a)} records != {len(records_b)} records"
+
+    if count_a != count_b:
+        return f"brick count {count_a} != {count_b}"
+
+    return None
+
+
+def verify_engines(engine_a: str, engine_b: str, *, height_map: np.ndarray, color_map: np.ndarray,
+                   color_set: BLS_ColorSet, bricks, bl_id: str, cull_mask: np.ndarray | None = None,
+                   gapfill: bool = False, optimize: bool = False, jobs: int | None = None) -> VerifyReport:
+    # Runs both engines stage by stage on the same input and compares the results after each stage
+    # color_map is the RGBA color map, before color matching, at the map's size or smaller.
+    # Stops at the first stage that diverges, later stages would only repeat the difference.
+    a = get_engine(engine_a, jobs=jobs)
+    b = get_engine(engine_b, jobs=jobs)
+    report = VerifyReport(engine_a, engine_b)
+    brick_height = bricks.brick_data["bricks"][0]["shape"][2]
+
+    def timed(func, *args):
+        start_time = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start_time
+
+    colors_a, time_a = timed(a.map_colors, color_set, color_map, height_map.shape)
+    colors_b, time_b = timed(b.map_colors, color_set, color_map, height_map.shape)
+    report.stages.append(StageResult("map_colors", time_a, time_b, first_array_divergence(colors_a, colors_b)))
+    if not report.ok:
+        return report
+
+    stages = [("setup_map", lambda engine: engine.setup_map(height_map, colors_a, cull_mask))]
+    if gapfill:
+        stages.append(("gap_fill", lambda engine: engine.gap_fill(brick_height)))
+    if optimize:
+        stages.append(("optimize", lambda engine: engine.optimize()))
+
+    for name, stage in stages:
+        _, time_a = timed(stage, a)
+        _, time_b = timed(stage, b)
+        report.stages.append(StageResult(name, time_a, time_b, first_map_divergence(a.map_array(), b.map_array())))
+        if not report.ok:
+            return report
+
+    (rows_a, count_a), time_a = timed(a.create_rows, bricks, bl_id)
+    (rows_b, count_b), time_b = timed(b.create_rows, bricks, bl_id)
+    report.stages.append(StageResult("create_save", time_a, time_b, first_record_divergence(rows_a, count_a, rows_b, count_b)))
+
+    return report
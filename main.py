@@ -67,6 +67,12 @@ class hm2bls(QMainWindow):
         
         self.ui.gv_cm.resizeEvent = self.resizeEvent
         self.rescale_img()
+        
+        # Progress of the generation stages is shown in the status bar
+        self.progress = hm.CallbackProgress(self.report_progress)
+        
+        # Decoded and mapped inputs are reused between Generate clicks while their files and settings don't change
+        self.cache = hm.SessionCache()
     
     
     def select_hm(self):       
@@ -147,6 +153,12 @@ class hm2bls(QMainWindow):
         super().resizeEvent(event)
         
         
+    def report_progress(self, progress: hm.Progress, event: str):
+        # Show the current stage in the status bar and keep the window responsive
+        self.statusBar().showMessage(f"{progress.stage}: {progress.fraction:.0%} ({progress.done}/{progress.total} {progress.unit})")
+        QApplication.processEvents()
+        
+        
     def start_generation(self):
         file_path, selected_filter = QFileDialog.getSaveFileName(self, "Select a location to save to", "./out/map.bls", "Blockland save file (*.bls)")
         
@@ -172,50 +184,75 @@ class hm2bls(QMainWindow):
         gapfill  = self.ui.cb_gapfill.isEnabled()
         optimize = self.ui.cb_optimize.isEnabled()
         
+        # Profiles go to a "profile" folder next to the save
+        if self.ui.cb_profile.isChecked():
+            profiler = hm.StageProfiler(Path(output).parent / "profile")
+        else:
+            profiler = hm.Profiler()
+        
+        
+        # Inputs come from the session cache when nothing they depend on changed
+        cache = self.cache
+        hits = cache.hits
+        hm_key = (cache.file_key(heightmap), x, y)
+        cs_key = cache.file_key(colorset)
         
         # Load and resize the height map
-        height_map = hm.load_heightmap(heightmap, x, y)
+        with profiler.profile("heightmap"):
+            height_map = cache.get("heightmap", hm_key, lambda: hm.load_heightmap(heightmap, x, y))
         
-        # Load and resize colormap == heightmap
+        # Load the colormap, a smaller one is matched at its own size
         hm_x = height_map.shape[0]
         hm_y = height_map.shape[1]
-        color_map = hm.load_colormap(colormap, hm_x, hm_y)
+        cm_key = (cache.file_key(colormap), hm_x, hm_y)
+        with profiler.profile("colormap"):
+            color_map = cache.get("colormap", cm_key, lambda: hm.load_colormap(colormap, hm_x, hm_y, native=True))
         
         # Load colorset
-        color_set = hm.BLS_ColorSet(path=colorset)
+        with profiler.profile("colorset"):
+            color_set = cache.get("colorset", cs_key, lambda: hm.BLS_ColorSet(path=colorset))
 
         # Map colorset
-        color_map = color_set.map_colors(color_map=color_map)
+        with profiler.profile("colors"):
+            color_map = cache.get("colors", (cm_key, cs_key),
+                                  lambda: hm.get_engine("numpy", progress=self.progress).map_colors(color_set, color_map, height_map.shape))
 
-        # Resize z axis
-        height_map = hm.resize_z(height_map, z)
-
-        # Clamp z axis to step
-        height_map = hm.clamp_step(height_map, step)
-        
-        # Sit map on the ground
-        if ground:
-            height_map = hm.ground(height_map)
+        # Resize z axis, clamp it to step and sit the map on the ground
+        with profiler.profile("heights"):
+            height_map = cache.get("heights", (hm_key, z, step, ground),
+                                   lambda: hm.transform_heights(height_map, z=z, step=step, ground=ground))
 
         # Load brick file
-        brick_file = hm.Bricks(bricks)
+        with profiler.profile("bricks"):
+            brick_file = cache.get("bricks", cache.file_key(bricks), lambda: hm.Bricks(bricks))
         
         # Set up map
         map = hm.MapGenerator(bricks=brick_file, height_map=height_map, 
                             color_map=color_map, bl_id=blid, 
-                            color_set=color_set, output_path=output)
-        map.setup_map()
+                            color_set=color_set, output_path=output,
+                            progress=self.progress)
+        with profiler.profile("setup_map"):
+            map.setup_map()
         
         # Gapfill
         if gapfill:
-            map.gap_fill()
+            with profiler.profile("gap_fill"):
+                map.gap_fill()
         
         # Brick optimization
         if optimize:
-            map.optimize()
+            with profiler.profile("optimize"):
+                map.optimize()
             
         # Create save file
-        map.create_save()
+        with profiler.profile("create_save"):
+            map.create_save()
+        
+        reused = f" (reused {cache.hits - hits} cached stages)" if cache.hits > hits else ""
+        if profiler.written():
+            self.statusBar().showMessage(f"Saved \"{output}\"{reused}, profiles written to \"{profiler.directory}\"")
+        else:
+            self.statusBar().showMessage(f"Saved \"{output}\"{reused}")
 
 
 def main():
@@ -0,0 +1,27 @@
+import io
+
+from hm2bls import blsutils
+from hm2bls.blsutils import BLS_File
+
+
+class _ShortWriteFile(io.FileIO):
+    # Unbuffered file that writes at most a few bytes per call, like a slow network volume can
+    def write(self, data):
+        return super().write(bytes(data[:5]))
+
+
+def test_direct_write_survives_short_writes(tmp_path, monkeypatch):
+    rows = [f"brick {i}\n" for i in range(500)]
+    expected = tmp_path / "expected.bls"
+    BLS_File(bricks=rows, brick_count=len(rows), colorset="", buffer_size=256).write(str(expected))
+
+    def short_open(path, mode="r", buffering=-1, *args, **kwargs):
+        if mode == "wb" and buffering == 0:
+            return _ShortWriteFile(path, "w")
+        return open(path, mode, buffering, *args, **kwargs)
+
+    monkeypatch.setattr(blsutils, "open", short_open, raising=False)
+    direct = tmp_path / "direct.bls"
+    BLS_File(bricks=rows, brick_count=len(rows), colorset="", buffer_size=256, direct=True).write(str(direct))
+
+    assert direct.read_bytes() == expected.read_bytes()
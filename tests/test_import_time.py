@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# "import hm2bls" and trivial CLI invocations must not pay for numpy or Pillow
+# (see the lazy names in hm2bls/__init__.py). Every check runs in a fresh interpreter, the
+# modules already imported by the test runner would hide an eager import otherwise.
+ROOT = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ("numpy", "PIL")
+# Import time budget in seconds, generous so slow CI machines don't fail it, a single eager
+# numpy import on its own takes longer than this on most machines
+IMPORT_BUDGET = 0.05
+
+
+def run_python(code: str) -> dict:
+    # Runs code in a fresh interpreter started in the repository, returns the JSON it prints last
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_loads_no_heavy_modules():
+    report = run_python(
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import hm2bls\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    assert report["loaded"] == []
+    assert report["elapsed"] < IMPORT_BUDGET, f"import hm2bls took {report['elapsed']:.3f}s"
+
+
+def test_lazy_names_resolve():
+    report = run_python(
+        "import json, sys\n"
+        "import hm2bls\n"
+        "missing = [name for name in hm2bls.__all__ if getattr(hm2bls, name, None) is None]\n"
+        "print(json.dumps({'missing': missing, 'numpy': 'numpy' in sys.modules}))\n"
+    )
+    assert report["missing"] == []
+    # Resolving the names is what imports numpy
+    assert report["numpy"]
+
+
+def test_help_loads_no_heavy_modules():
+    report = run_python(
+        "import contextlib, io, json, runpy, sys\n"
+        "sys.argv = ['hm2bls.py', '--help']\n"
+        "with contextlib.redirect_stdout(io.StringIO()) as out:\n"
+        "    try:\n"
+        "        runpy.run_path('hm2bls.py', run_name='__main__')\n"
+        "    except SystemExit as e:\n"
+        "        code = e.code\n"
+        f"print(json.dumps({{'code': code, 'usage': out.getvalue().startswith('usage:'), "
+        f"'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    assert report["code"] in (0, None)
+    assert report["usage"]
+    assert report["loaded"] == []
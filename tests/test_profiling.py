@@ -0,0 +1,75 @@
+import cProfile
+import pstats
+import time
+
+from hm2bls.profiling import collapse_pstats
+
+# Collapsing runs after every profiled stage, so it has to stay fast on real profiles
+COLLAPSE_BUDGET = 2.0
+
+
+def _layered_program(layers: int = 30, width: int = 10):
+    # layers x width functions, each calling every function of the next layer, with the last layer
+    # calling back into the first, so the profile has hundreds of functions, a number of distinct
+    # call paths that grows exponentially with the depth, and recursion
+    namespace = {"depth": [0]}
+    source = []
+    for layer in range(layers):
+        for k in range(width):
+            calls = [f"f_{layer + 1}_{j}()" for j in range(width)] if layer + 1 < layers else [
+                "f_0_0() if depth[0] < 2 else None"]
+            source.append(f"def f_{layer}_{k}():\n"
+                          f"    depth[0] += 1\n"
+                          f"    if depth[0] < 4:\n"
+                          + "".join(f"        {call}\n" for call in calls) +
+                          f"    depth[0] -= 1\n"
+                          f"    return sum(range(20))\n")
+    exec("\n".join(source), namespace)
+
+    def run():
+        for layer in range(layers):
+            for k in range(width):
+                namespace[f"f_{layer}_{k}"]()
+    return run
+
+
+def test_collapse_pstats_is_fast_on_large_profiles():
+    run = _layered_program()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    run()
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    assert len(stats.stats) > 300
+
+    start = time.perf_counter()
+    stacks = collapse_pstats(stats)
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < COLLAPSE_BUDGET, f"collapse_pstats took {elapsed:.2f}s"
+    assert stacks
+    # Every stack is cut at max_depth callers
+    assert max(stack.count(";") for stack in stacks) <= 64
+
+
+def test_collapse_pstats_splits_own_time_over_callers():
+    def leaf():
+        return sum(range(2000))
+
+    def left():
+        return [leaf() for _ in range(200)]
+
+    def right():
+        return [leaf() for _ in range(200)]
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    left()
+    right()
+    profiler.disable()
+
+    stacks = collapse_pstats(pstats.Stats(profiler))
+    leaf_label = f"leaf (test_profiling.py:{leaf.__code__.co_firstlineno})"
+    leaf_stacks = [stack for stack in stacks if stack.endswith(leaf_label)]
+    assert any("left" in stack for stack in leaf_stacks)
+    assert any("right" in stack for stack in leaf_stacks)